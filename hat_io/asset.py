@@ -1,11 +1,33 @@
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 import ndspy.lz10
-from functools import partial
+import re
+from collections import Counter
+from concurrent.futures import Executor
+from heapq import heapify, heappop, heappush
+from mmap import mmap, ACCESS_READ
 from os import makedirs
 from . import binary
+from .cache import DecompressionCache
 from ..common import logSevere
 from .const import ENCODING_DEFAULT_STRING
 
+_HUFFMAN_TRANSLATE_MSB_NIBBLE           = bytes(((value << 4) & 0xFF) for value in range(256))
+_HUFFMAN_TRANSLATE_MSB_TO_LSB_NIBBLE    = bytes((value >> 4) for value in range(256))
+_HUFFMAN_TRANSLATE_LSB_NIBBLE           = bytes((value & 0x0F) for value in range(256))
+
+# Lookup table entry for a branch missing from a malformed tree
+_HUFFMAN_LOOKUP_MISSING_BRANCH          = (b'', 0, 0, None)
+
+_RLE_PATTERN_RUN = re.compile(rb'(.)\1{2,}', re.DOTALL)
+
+def _swapWordEndianness(data : bytes) -> bytearray:
+    # Reverse every 32-bit word. Trailing partial words are zero-extended at their most significant end
+    data = bytes(data) + bytes(-len(data) % 4)
+    output = bytearray(len(data))
+    for indexByte in range(4):
+        output[indexByte::4] = data[3 - indexByte::4]
+    return output
+
 class _HuffmanCompressionNode():
     def __init__(self, parent=None, left=None, right=None, weight=0, data=None):
         self.parent = parent
@@ -73,6 +95,54 @@ class _HuffmanTree():
         writer.insert(((writer.tell() // 2) - 1).to_bytes(1, byteorder = 'little'), 0)
         return writer.data
 
+    def getCodes(self):
+        # Walk the tree once to get (code, length) pairs for every leaf, where taking the right branch is a set bit
+        codes = {}
+        stack = [(self.root, 0, 0)]
+        while len(stack) > 0:
+            node, code, length = stack.pop()
+            if node.data != None:
+                codes[node.data[0]] = (code, length)
+            else:
+                stack.append((node.left, code << 1, length + 1))
+                stack.append((node.right, (code << 1) | 1, length + 1))
+        return codes
+
+    def getLookupTable(self, node, bits):
+        # Flatten all paths of 'bits' length under this node into a table indexed by the next 'bits' of the stream.
+        #     Each entry is (symbols decoded, count decoded, bits consumed, node to continue from if no symbol was reached in time)
+        #     Decoding restarts from the root after every symbol so short codes can resolve several symbols per probe.
+        #     Truncated trees can be missing branches, which are only a problem if the stream takes them, so mark them instead of failing
+        table = [None] * (1 << bits)
+
+        def fillTable(node, prefix, depth, symbols, depthLastSymbol):
+            if node == None:
+                for prefixMissing in range(prefix << (bits - depth), (prefix + 1) << (bits - depth)):
+                    table[prefixMissing] = _HUFFMAN_LOOKUP_MISSING_BRANCH
+                return
+            if node.data != None:
+                symbols = symbols + node.data
+                depthLastSymbol = depth
+                node = self.root
+            if depth == bits:
+                if len(symbols) > 0:
+                    table[prefix] = (symbols, len(symbols), depthLastSymbol, None)
+                else:
+                    table[prefix] = (symbols, 0, depth, node)
+            else:
+                fillTable(node.left, prefix << 1, depth + 1, symbols, depthLastSymbol)
+                fillTable(node.right, (prefix << 1) | 1, depth + 1, symbols, depthLastSymbol)
+
+        fillTable(node, 0, 0, b'', 0)
+        return table
+
+def _getCompressedCandidate(data : bytes, nameMethod : str, addHeader : bool, kwargs : dict) -> Optional[bytearray]:
+    # Module-level so candidates can be pickled over to process pools
+    candidate = File(data = data)
+    if getattr(candidate, nameMethod)(addHeader = addHeader, **kwargs) == False:
+        return None
+    return candidate.data
+
 class File():
 
     COMP_HUFFMAN_8_BIT      = 0x28
@@ -80,6 +150,11 @@ class File():
     COMP_RLE                = 0x30
     COMP_LZ10               = 0x10
 
+    HUFFMAN_LOOKUP_BITS     = 10
+
+    # Shared cache for decompress, eg DecompressionCache("cache") to reuse output across runs
+    DECOMPRESSION_CACHE     : Optional[DecompressionCache] = None
+
     LAYTON_1_COMPRESSION    = {COMP_RLE:b'\x01\x00\x00\x00',
                                COMP_LZ10:b'\x02\x00\x00\x00',
                                COMP_HUFFMAN_4_BIT:b'\x03\x00\x00\x00',
@@ -93,18 +168,38 @@ class File():
     def __str__(self):
         return str(len(self.data)) + "\t" + self.name
 
-    def compress(self, addHeader=False): # Get optimal compression
-        def copyCompress(compressionMethod):
-            uncompressed = self.data
-            compressionMethod(addHeader = addHeader)
-            compressed = self.data
-            self.data = uncompressed
-            return compressed
+    def compress(self, addHeader=False, executor : Optional[Executor] = None): # Get optimal compression
+        """Compresses the data with every supported method and keeps the shortest output. Ties go to the earliest method tried.
 
-        compList = [copyCompress(self.compressHuffman), copyCompress(partial(self.compressHuffman, True)),
-                    copyCompress(self.compressLz10)]
-        compList.sort(key=len)
-        self.data = compList[0]
+        Serially, candidates that can predict their output length (Huffman) are abandoned once they cannot beat the best result so far.
+
+        Args:
+            addHeader (bool, optional): Prefix output with the LAYTON1 compression header. Defaults to False.
+            executor (Optional[Executor], optional): Executor to evaluate all candidates concurrently, eg a ProcessPoolExecutor shared across files. Defaults to None.
+        """
+        candidates = [("compressHuffman", {"useHalfByteBlocks":False}, True),
+                      ("compressHuffman", {"useHalfByteBlocks":True}, True),
+                      ("compressLz10", {}, False),
+                      ("compressRle", {}, False)]
+
+        compressed = None
+        if executor == None:
+            for nameMethod, kwargs, canAbort in candidates:
+                if canAbort and compressed != None:
+                    kwargs = dict(kwargs, lengthLimit = len(compressed) - 1)
+                candidate = _getCompressedCandidate(self.data, nameMethod, addHeader, kwargs)
+                if candidate != None and (compressed == None or len(candidate) < len(compressed)):
+                    compressed = candidate
+        else:
+            uncompressed = bytes(self.data)
+            futures = []
+            for nameMethod, kwargs, _canAbort in candidates:
+                futures.append(executor.submit(_getCompressedCandidate, uncompressed, nameMethod, addHeader, kwargs))
+            for future in futures:
+                candidate = future.result()
+                if compressed == None or len(candidate) < len(compressed):
+                    compressed = candidate
+        self.data = compressed
 
     def detectDecompressionMethod(self, byteMagic, bytesLen, offsetIn=0):
         # TODO - goal_inf.dlz is shorter; there's got to be a better way to detect compressed files
@@ -118,78 +213,132 @@ class File():
                 return self.decompressLz10
         return None
 
-    def decompress(self, detectTypeHeader=True, forceTypeHeader=False):
-        if len(self.data) > 4:
-            decompressMethod = self.detectDecompressionMethod(self.data[0], self.data[1:4])
-            offsetIn = 0
-            if (forceTypeHeader or (detectTypeHeader and decompressMethod == None and len(self.data) >= 8)):
-                decompressMethod = self.detectDecompressionMethod(self.data[4], self.data[5:8], offsetIn=4)
-                offsetIn = 4
-            if decompressMethod != None:
-                try:
-                    return decompressMethod(offsetIn = offsetIn)
-                except:
-                    return False
+    def getDecompressionMethod(self, detectTypeHeader=True, forceTypeHeader=False) -> Tuple[Optional[Callable[..., bool]], int]:
+        """Detects the compression method from the header without decompressing anything.
+
+        Args:
+            detectTypeHeader (bool, optional): Also check for a LAYTON1 compression header if the data isn't recognised. Defaults to True.
+            forceTypeHeader (bool, optional): Assume a LAYTON1 compression header is present. Defaults to False.
+
+        Returns:
+            Tuple[Optional[Callable[..., bool]], int]: Bound decompression method, or None if the data doesn't look compressed, and offset to compressed data.
+        """
+        if len(self.data) <= 4:
+            return (None, 0)
+        decompressMethod = self.detectDecompressionMethod(self.data[0], self.data[1:4])
+        offsetIn = 0
+        if (forceTypeHeader or (detectTypeHeader and decompressMethod == None and len(self.data) >= 8)):
+            decompressMethod = self.detectDecompressionMethod(self.data[4], self.data[5:8], offsetIn=4)
+            offsetIn = 4
+        return (decompressMethod, offsetIn)
+
+    def decompress(self, detectTypeHeader=True, forceTypeHeader=False, cache : Optional[DecompressionCache] = None):
+        """Decompresses the data in place, detecting the compression method from its header.
+
+        Args:
+            detectTypeHeader (bool, optional): Also check for a LAYTON1 compression header if the data isn't recognised. Defaults to True.
+            forceTypeHeader (bool, optional): Assume a LAYTON1 compression header is present. Defaults to False.
+            cache (Optional[DecompressionCache], optional): Cache to reuse earlier output from. Defaults to None, which uses File.DECOMPRESSION_CACHE.
+
+        Returns:
+            bool: True if the data was decompressed.
+        """
+        decompressMethod, offsetIn = self.getDecompressionMethod(detectTypeHeader=detectTypeHeader, forceTypeHeader=forceTypeHeader)
+        if decompressMethod != None:
+            if cache == None:
+                cache = File.DECOMPRESSION_CACHE
+            
+            if cache != None:
+                key = DecompressionCache.getKey(self.data, decompressMethod.__name__ + str(offsetIn))
+                cached = cache.get(key)
+                if cached != None:
+                    self.data = bytearray(cached)
+                    return True
+
+            try:
+                result = decompressMethod(offsetIn = offsetIn)
+            except:
+                return False
+            
+            if result and cache != None:
+                cache.put(key, self.data)
+            return result
         return False
 
-    def compressHuffman(self, useHalfByteBlocks = False, addHeader=False):
-        reader = binary.BinaryReader(data = self.data)
-        freqDict = {}
-        while reader.hasDataRemaining():    # Build frequency table
-            tempByte = [bytes(reader.read(1))]
-            if useHalfByteBlocks:
-                tempByte[0] = int.from_bytes(tempByte[0], byteorder = 'little')
-                tempByte = [(tempByte[0] >> 4).to_bytes(1, byteorder = 'little'), (tempByte[0] & 0x0F).to_bytes(1, byteorder = 'little')]
-            for block in tempByte:
-                if block not in freqDict.keys():
-                    freqDict[block] = _HuffmanCompressionNode(data = block)
-                freqDict[block].weight += 1
-
-        nodes = freqDict.values()
-        if len(nodes) > 2**9:
+    def compressHuffman(self, useHalfByteBlocks = False, addHeader=False, lengthLimit : Optional[int] = None) -> bool:
+        if useHalfByteBlocks:
+            # Split into nibbles in stream order, MSB first
+            blocks = bytearray(len(self.data) * 2)
+            blocks[0::2] = bytes(self.data).translate(_HUFFMAN_TRANSLATE_MSB_TO_LSB_NIBBLE)
+            blocks[1::2] = bytes(self.data).translate(_HUFFMAN_TRANSLATE_LSB_NIBBLE)
+            countSymbols = 16
+        else:
+            blocks = bytes(self.data)
+            countSymbols = 256
+
+        freqDict = Counter(blocks)          # Build frequency table, preserving order of first appearance
+        if len(freqDict) > 2**9:
             raise Exception("Huffman encode: Tree too long to be encoded!")
 
-        while len(nodes) > 1:   # Build Huffman tree by grouping nodes
-            nodes = sorted(nodes, key=lambda huffNode : huffNode.weight)
-            newNode = _HuffmanCompressionNode(left = nodes[0], right = nodes[1], weight = nodes[0].weight + nodes[1].weight)
-            newNode.left.parent = newNode
-            newNode.right.parent = newNode
-            nodes = nodes[2:]
-            nodes.append(newNode)
+        # Trees need at least one branch, so pad with unused symbols that will never be emitted
+        for symbol in range(countSymbols):
+            if len(freqDict) >= 2:
+                break
+            if symbol not in freqDict:
+                freqDict[symbol] = 0
+
+        # Build Huffman tree by grouping nodes. Ties are broken by order of insertion to match the previous stable sort
+        nodes = []
+        for indexNode, (symbol, weight) in enumerate(freqDict.items()):
+            nodes.append((weight, indexNode, _HuffmanCompressionNode(weight = weight, data = symbol.to_bytes(1, byteorder = 'little'))))
+        heapify(nodes)
+        indexNode = len(nodes)
+        while len(nodes) > 1:
+            weightLeft, _indexLeft, nodeLeft = heappop(nodes)
+            weightRight, _indexRight, nodeRight = heappop(nodes)
+            newNode = _HuffmanCompressionNode(left = nodeLeft, right = nodeRight, weight = weightLeft + weightRight)
+            nodeLeft.parent = newNode
+            nodeRight.parent = newNode
+            heappush(nodes, (newNode.weight, indexNode, newNode))
+            indexNode += 1
+
+        tree = _HuffmanTree(nodes[0][2])
+        encodedTree = tree.encode()
+        codes = tree.getCodes()
+
+        if lengthLimit != None:
+            # Output length is known exactly before packing, so give up early if it won't fit
+            countBits = 0
+            for symbol, weight in freqDict.items():
+                countBits += weight * codes[symbol][1]
+            lengthOutput = 4 + len(encodedTree) + (((countBits + 31) // 32) * 4)
+            if lengthOutput % 4 == 0:
+                lengthOutput += 4
+            else:
+                lengthOutput += 4 - (lengthOutput % 4)
+            if addHeader:
+                lengthOutput += 4
+            if lengthOutput > lengthLimit:
+                return False
 
-        tree = _HuffmanTree(nodes[0])
-        
         writer = binary.BinaryWriter()
         if useHalfByteBlocks:
             writer.writeInt(File.COMP_HUFFMAN_4_BIT, 1)
         else:
             writer.writeInt(File.COMP_HUFFMAN_8_BIT, 1)
         writer.writeInt(len(self.data), 3)
-        writer.write(tree.encode())
-        
-        keyDict = {}
-        for key in freqDict.keys():
-            keyDict[freqDict[key].data] = freqDict[key].getBoolCode()
-        
-        reader.seek(0)
-        compressionBlock = 0
-        compressionBlockBitsRemaining = 32
-        while reader.hasDataRemaining():    # Ported from DsDecmp
-            tempByte = [reader.read(1)]
-            if useHalfByteBlocks:
-                tempByte[0] = int.from_bytes(tempByte[0], byteorder = 'little')
-                tempByte = [(tempByte[0] >> 4).to_bytes(1, byteorder = 'little'), (tempByte[0] & 0x0F).to_bytes(1, byteorder = 'little')]
-            for data in tempByte:
-                for bit in keyDict[bytes(data)]:
-                    if compressionBlockBitsRemaining == 0:
-                        writer.writeU32(compressionBlock)
-                        compressionBlock = 0
-                        compressionBlockBitsRemaining = 32
-                    compressionBlockBitsRemaining -= 1
-                    if bit:
-                        compressionBlock = compressionBlock | (1 << compressionBlockBitsRemaining)
-        if compressionBlockBitsRemaining != 32:
-            writer.writeU32(compressionBlock)
+        writer.write(encodedTree)
+
+        # Expand every symbol to its code as text so the whole bitstream is assembled in one pass
+        bitStrings = [''] * countSymbols
+        for symbol, (code, length) in codes.items():
+            bitStrings[symbol] = format(code, 'b').zfill(length)
+        bitStream = ''.join(map(bitStrings.__getitem__, blocks))
+        bitStream += '0' * (-len(bitStream) % 32)
+
+        # Ported from DsDecmp - bits are packed MSB first into little-endian words
+        if len(bitStream) > 0:
+            writer.write(_swapWordEndianness(int(bitStream, 2).to_bytes(len(bitStream) // 8, byteorder = 'big')))
         writer.dsAlign(4, 4)
 
         if addHeader:
@@ -199,9 +348,13 @@ class File():
                 self.data = File.LAYTON_1_COMPRESSION[File.COMP_HUFFMAN_8_BIT] + writer.data
         else:
             self.data = writer.data
+        return True
 
-    def decompressHuffman(self, offsetIn=0):
-        reader = binary.BinaryReader(data = self.data)
+    def decompressHuffman(self, offsetIn=0, useLookupTable=True):
+        if useLookupTable:
+            return self.decompressHuffmanLookup(offsetIn = offsetIn)
+
+        reader = binary.BinaryReader(data = self.data, zeroCopy = True)
         reader.seek(offsetIn)
         magic = reader.readUInt(1)
         if magic & 0xF0 != 0x20:
@@ -237,6 +390,9 @@ class File():
                     tempIntData = int.from_bytes(currentNode.data, byteorder = 'little') << 4
                 else:
                     tempIntData |= int.from_bytes(currentNode.data, byteorder = 'little')        
+                    if tempIntData > 0xFF:
+                        # Symbol was wider than a nibble so doesn't fit in the byte
+                        return False
                     writer.writeInt(tempIntData, 1)
                 isMsbNibble = not(isMsbNibble)
             else:
@@ -244,82 +400,149 @@ class File():
             currentNode = tree.root
 
         if useHalfByteBlocks and not(isMsbNibble):
+            if tempIntData > 0xFF:
+                return False
             writer.writeInt(tempIntData, 1)
         self.data = writer.data[:tempFilesize]
         return True
 
-    def compressRle(self, addHeader=False):
-        writer = binary.BinaryWriter()
-        reader = binary.BinaryReader(data = self.data)
+    def decompressHuffmanLookup(self, offsetIn=0, lookupBits=HUFFMAN_LOOKUP_BITS):
+        """Table-driven Huffman decoder. Output is identical to the tree-walking decoder, but codes are resolved up to lookupBits at a time.
 
-        tempCompressedByte = b''
-        tempCompressedByteLength = 0
-        tempUncompressedSection = bytearray(b'')
-        compressRepetition = False
+        Args:
+            offsetIn (int, optional): Offset to start of compressed data. Defaults to 0.
+            lookupBits (int, optional): Bits resolved per table probe. Limited to 1-16. Defaults to HUFFMAN_LOOKUP_BITS.
 
-        def getRleFlagByte(isCompressed, length):
-            if isCompressed:
-                return (0x80 | (length - 3)).to_bytes(1, byteorder = 'little')          # Enable MSB compression flag
-            return (length - 1).to_bytes(1, byteorder = 'little')
-        
-        def writeData():
-            if len(tempUncompressedSection) > 0:
-                writer.write(getRleFlagByte(False, len(tempUncompressedSection)) + tempUncompressedSection)
-            if tempCompressedByteLength > 0:
-                writer.write(getRleFlagByte(True, tempCompressedByteLength) + tempCompressedByte)
-        
-        while reader.hasDataRemaining():
-            tempByte = reader.read(1)
-            if compressRepetition:
-                if tempByte == tempCompressedByte:
-                    tempCompressedByteLength += 1
-                if tempCompressedByteLength == 130 or tempByte != tempCompressedByte:   # If max size has been reached or there's no more repetition
-                    compressRepetition = False
-                    if tempCompressedByteLength < 3:                                    # Free data if compression won't do much
-                        tempUncompressedSection.extend((tempCompressedByte * tempCompressedByteLength) + tempByte)
-                    else:                                                               # Else, write uncompressed section, then compressed data
-                        writeData()
-                        if tempByte == tempCompressedByte:                              # If the compression ended because the max block size was met,
-                            tempUncompressedSection = bytearray(b'')                    #     reinitiate the uncompressed section.
-                        else:
-                            tempUncompressedSection = bytearray(tempByte)               # Else, continue the uncompressed section as normal.
-                    tempCompressedByteLength = 0
+        Returns:
+            bool: True if the data was decompressed.
+        """
+        lookupBits = min(max(lookupBits, 1), 16)
+        reader = binary.BinaryReader(data = self.data, zeroCopy = True)
+        reader.seek(offsetIn)
+        magic = reader.readUInt(1)
+        if magic & 0xF0 != 0x20:
+            return False
+        useHalfByteBlocks = magic & 0x0F == 0x04
+
+        tempFilesize = reader.readUInt(3)
+        tempTreeLength = (reader.readUInt(1) * 2) + 1
+        tree = _HuffmanTree.decode(reader, offsetIn, offsetIn + tempTreeLength + 5)
+
+        # Bitstream is stored as little-endian words read MSB first, so swap each word to get one continuous big-endian stream.
+        #     Missing bytes are zero, matching the short reads of the tree-walking decoder
+        offsetStream = offsetIn + tempTreeLength + 5
+        stream = _swapWordEndianness(self.data[offsetStream:]) + bytes(4)
+
+        if useHalfByteBlocks:
+            countSymbols = tempFilesize * 2
+        else:
+            countSymbols = tempFilesize
+        tables = {}
+        rootTable = tree.getLookupTable(tree.root, lookupBits)
+        maskProbe = (1 << lookupBits) - 1
+        shiftWindow = 24 - lookupBits
+        lengthStream = len(stream) - 3
+        posBit = 0
+        indexSymbol = 0
+        table = rootTable
+        symbols = []
+        while indexSymbol < countSymbols:
+            posByte = posBit >> 3
+            if posByte >= lengthStream:
+                # Ran off the end of the data, so continue on zero bits
+                window = 0
             else:
-                tempUncompressedSection.extend(tempByte)
-                if len(tempUncompressedSection) == 128:                                 # Reinitiate block if max size met
-                    writeData()
-                    tempUncompressedSection = bytearray(b'')
-                elif len(tempUncompressedSection) > 1 and tempUncompressedSection[-2] == tempUncompressedSection[-1]:
-                    tempCompressedByte = tempByte
-                    tempCompressedByteLength = 2
-                    compressRepetition = True
-                    tempUncompressedSection = tempUncompressedSection[0:-2]
-        # Write anything left, as there may be blocks remaining after the reader ran out of data
-        writeData()
+                window = (stream[posByte] << 16) | (stream[posByte + 1] << 8) | stream[posByte + 2]
+            decoded, countDecoded, lengthCode, nextNode = table[(window >> (shiftWindow - (posBit & 7))) & maskProbe]
+            posBit += lengthCode
+            if countDecoded:
+                symbols.append(decoded)
+                indexSymbol += countDecoded
+                table = rootTable
+            elif nextNode == None:
+                # Stream took a branch missing from the tree, so leave it to the tree-walking decoder to handle however it does
+                return self.decompressHuffman(offsetIn = offsetIn, useLookupTable = False)
+            else:
+                if nextNode not in tables:
+                    tables[nextNode] = tree.getLookupTable(nextNode, lookupBits)
+                table = tables[nextNode]
+        # Probes can overshoot by a few symbols past the end so trim them
+        symbols = b''.join(symbols)[:countSymbols]
+
+        if useHalfByteBlocks:
+            # Malformed trees can hold symbols wider than a nibble. Match the tree-walking decoder: an oversized MSB doesn't fit in
+            #     the packed byte so fails, while an oversized LSB is OR'd straight into it
+            msbSymbols = symbols[0::2]
+            if len(msbSymbols) > 0 and max(msbSymbols) > 0x0F:
+                return False
+            # Pack nibble pairs without a per-byte loop by treating each half as one large integer. OR never carries between bytes
+            msbNibbles = msbSymbols.translate(_HUFFMAN_TRANSLATE_MSB_NIBBLE)
+            packed = int.from_bytes(msbNibbles, byteorder = 'big') | int.from_bytes(symbols[1::2], byteorder = 'big')
+            self.data = bytearray(packed.to_bytes(tempFilesize, byteorder = 'big'))
+        else:
+            self.data = bytearray(symbols)
+        return True
+
+    def compressRle(self, addHeader=False):
+        writer = binary.BinaryWriter()
+        data = bytes(self.data)
+
+        def writeUncompressed(start, end):
+            for offsetBlock in range(start, end, 128):
+                block = data[offsetBlock:min(offsetBlock + 128, end)]
+                writer.write((len(block) - 1).to_bytes(1, byteorder = 'little'))   # Uncompressed blocks store length - 1
+                writer.write(block)
+
+        # Every run of 3 or more is cheaper compressed. Runs longer than a block are split, and anything under 3 left
+        #     at the end of a run goes back into the uncompressed section that follows it
+        offsetUncompressed = 0
+        for run in _RLE_PATTERN_RUN.finditer(data):
+            offsetRun, offsetRunEnd = run.span()
+            lengthRemainder = (offsetRunEnd - offsetRun) % 130
+            if lengthRemainder < 3:
+                offsetRunEnd -= lengthRemainder
+
+            writeUncompressed(offsetUncompressed, offsetRun)
+            for offsetBlock in range(offsetRun, offsetRunEnd, 130):
+                lengthBlock = min(130, offsetRunEnd - offsetBlock)
+                writer.write((0x80 | (lengthBlock - 3)).to_bytes(1, byteorder = 'little'))   # Enable MSB compression flag
+                writer.write(data[offsetRun:offsetRun + 1])
+            offsetUncompressed = offsetRunEnd
+        writeUncompressed(offsetUncompressed, len(data))
+
         if addHeader:
             self.data = bytearray(File.LAYTON_1_COMPRESSION[File.COMP_RLE] + File.COMP_RLE.to_bytes(1, byteorder='little') + len(self.data).to_bytes(3, byteorder = 'little') + writer.data)
         else:
-            self.data = bytearray(File.COMP_RLE + len(self.data).to_bytes(3, byteorder = 'little') + writer.data)
+            self.data = bytearray(File.COMP_RLE.to_bytes(1, byteorder='little') + len(self.data).to_bytes(3, byteorder = 'little') + writer.data)
+        return True
             
     def decompressRle(self, offsetIn=0):
-        reader = binary.BinaryReader(data = self.data)
+        reader = binary.BinaryReader(data = self.data, zeroCopy = True)
         reader.seek(offsetIn)
         if reader.readUInt(1) != File.COMP_RLE:
             return False
         tempFilesize = reader.readUInt(3)
-        writer = binary.BinaryWriter()
-        while writer.tell() < tempFilesize:
-            flag = int.from_bytes(reader.read(1), byteorder = 'little')
-            isCompressed = (flag & 0x80) > 0
-            if isCompressed:
-                decompressedLength = (flag & 0x7f) + 3
-                decompressedData = reader.read(1)
-                for _indexByte in range(decompressedLength):
-                    writer.write(decompressedData)
+        data = bytes(self.data)
+        output = bytearray(tempFilesize)
+        offsetIn = reader.tell()
+        offsetOut = 0
+        while offsetOut < tempFilesize:
+            if offsetIn >= len(data):
+                return False
+            flag = data[offsetIn]
+            if flag & 0x80:
+                decompressedLength = min((flag & 0x7f) + 3, tempFilesize - offsetOut)
+                decompressedData = data[offsetIn + 1:offsetIn + 2] * decompressedLength
+                offsetIn += 2
             else:
-                decompressedLength = (flag & 0x7f) + 1
-                writer.write(reader.read(decompressedLength))
-        self.data = writer.data
+                decompressedLength = min((flag & 0x7f) + 1, tempFilesize - offsetOut)
+                decompressedData = data[offsetIn + 1:offsetIn + 1 + decompressedLength]
+                offsetIn += decompressedLength + 1
+            if len(decompressedData) != decompressedLength:
+                return False
+            output[offsetOut:offsetOut + decompressedLength] = decompressedData
+            offsetOut += decompressedLength
+        self.data = output
         return True
     
     def compressLz10(self, addHeader=False):
@@ -327,6 +550,7 @@ class File():
             self.data = File.LAYTON_1_COMPRESSION[File.COMP_LZ10] + ndspy.lz10.compress(self.data)
         else:
             self.data = ndspy.lz10.compress(self.data)
+        return True
 
     def decompressLz10(self, offsetIn=0):
         try:
@@ -364,17 +588,107 @@ class File():
     
     @staticmethod
     def load(filepath):
-        reader = binary.BinaryReader(filename = filepath)
+        reader = binary.BinaryReader(filename = filepath, zeroCopy = True)
         tempName = filepath.split("//")[-1]
         if tempName == "":
             logSevere("Invalid filename!", name="FileImport")
             tempName = "NULL"
-        return File(name=tempName, data=reader.data)
+        output = File(name=tempName, data=reader.data)
+        reader.close()
+        return output
 
 class Archive(File):
     def __init__(self, name=""):
         File.__init__(self, name=name)
-        self.files : List[File] = []
+        self._files : List[File] = []
+
+        self._entriesLazy : List[Tuple[str, int, int]] = []
+        self._indexLazy : Dict[str, Tuple[int, int]] = {}
+        self._dataLazy : Optional[memoryview] = None
+        self._mapLazy : Optional[mmap] = None
+
+    @property
+    def files(self) -> List[File]:
+        # Lazily loaded members are only copied out when the whole list is needed
+        if self._dataLazy != None:
+            self._files = [File(name, data = self._dataLazy[offset:offset + length]) for name, offset, length in self._entriesLazy]
+            self.close()
+        return self._files
+    
+    @files.setter
+    def files(self, files : List[File]):
+        self.close()
+        self._files = files
+
+    def isLazy(self) -> bool:
+        """Checks whether members are still being served from the archive data rather than as loaded files.
+
+        Returns:
+            bool: True if the archive was loaded lazily and the member list has not been accessed since.
+        """
+        return self._dataLazy != None
+
+    def _clearLazy(self):
+        self._entriesLazy = []
+        self._indexLazy = {}
+
+    def _addLazyFile(self, name : str, offset : int, length : int):
+        self._entriesLazy.append((name, offset, length))
+        if name not in self._indexLazy:
+            self._indexLazy[name] = (offset, length)
+
+    def loadMapped(self, filepath : str) -> bool:
+        """Loads an archive lazily from a memory-mapped file. Members are read from the mapping on demand, so the file must not be modified
+        until close is called or the member list is accessed.
+
+        Args:
+            filepath (str): Path to archive.
+
+        Returns:
+            bool: True if the archive was loaded successfully.
+        """
+        self.close()
+        try:
+            with open(filepath, 'rb') as dataIn:
+                mapped = mmap(dataIn.fileno(), 0, access=ACCESS_READ)
+        except FileNotFoundError:
+            logSevere("Path", filepath, "doesn't exist!", name="ArcImport")
+            return False
+        except (IOError, ValueError):
+            return False
+
+        # load closes any previous state first, so only hold onto the mapping once loading has succeeded
+        view = memoryview(mapped)
+        if self.load(view, lazy=True):
+            self._mapLazy = mapped
+            return True
+        
+        self.close()
+        self.data = bytearray(b'')
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            pass
+        return False
+
+    def close(self):
+        """Releases the data held for lazily loaded members. Does nothing if the archive was not loaded lazily.
+        """
+        self._clearLazy()
+        if self._dataLazy != None:
+            self._dataLazy.release()
+            self._dataLazy = None
+        if self._mapLazy != None:
+            if self.data is not self._mapLazy and type(self.data) == memoryview:
+                self.data.release()
+            self.data = bytearray(b'')
+            try:
+                self._mapLazy.close()
+            except BufferError:
+                # Members are still being viewed elsewhere; the mapping will close once they are freed
+                logSevere("Archive mapping still in use, deferring close!", name="ArcClose")
+            self._mapLazy = None
 
     def extract(self, filepath):
         outputFilepath = "\\".join(filepath.split("\\")) + "\\" + self.name.split("\\")[-1]
@@ -384,8 +698,23 @@ class Archive(File):
                 dataOut.write(fileChunk.data)
     
     def getFile(self, name):
-        # TODO - Optimise with a dictionary
-        for file in self.files:
+        """Gets data for the first member with a given name.
+
+        Args:
+            name (str): Name of member.
+
+        Returns:
+            Optional[bytearray]: Member data, or None if no member matched. For lazily loaded archives this is a memoryview into the
+            archive data, so should be converted if it needs to outlive the archive.
+        """
+        if self._dataLazy != None:
+            entry = self._indexLazy.get(name)
+            if entry == None:
+                return None
+            return self._dataLazy[entry[0]:entry[0] + entry[1]]
+        
+        # Members can be replaced or renamed freely, so search the list rather than keeping an index that could go stale
+        for file in self._files:
             if file.name == name:
                 return file.data
         return None
@@ -399,9 +728,19 @@ class LaytonPack(Archive):
         Archive.__init__(self, name=name)
         self._version = version
 
-    def load(self, data):
+    def load(self, data, lazy=False):
+        """Loads archive contents.
+
+        Args:
+            data (bytearray): Archive data.
+            lazy (bool, optional): Only index members, serving them from data on demand with getFile. data must outlive the archive. Defaults to False.
+
+        Returns:
+            bool: True if the archive was loaded successfully.
+        """
+        self.close()
         self.data = data
-        reader = binary.BinaryReader(data = data)
+        reader = binary.BinaryReader(data = data, zeroCopy = True)
         offsetHeader = reader.readU32()
         lengthArchive = reader.readU32()
         if self._version == 0:
@@ -411,11 +750,18 @@ class LaytonPack(Archive):
             reader.seek(offsetHeader)
             while reader.tell() != lengthArchive:
                 metadata = reader.readU32List(4)
-                self.files.append(File(name = reader.readPaddedString(metadata[0] - LaytonPack.METADATA_BLOCK_SIZE, encoding = ENCODING_DEFAULT_STRING),
-                                       data = reader.read(metadata[3])))
+                name = reader.readPaddedString(metadata[0] - LaytonPack.METADATA_BLOCK_SIZE, encoding = ENCODING_DEFAULT_STRING)
+                if lazy:
+                    self._addLazyFile(name, reader.tell(), metadata[3])
+                    reader.seek(metadata[3], 1)
+                else:
+                    self.files.append(File(name = name, data = reader.read(metadata[3])))
                 reader.seek(metadata[1] - (metadata[3] + metadata[0]), 1)
+            if lazy:
+                self._dataLazy = reader.data
             return True
         except ValueError:
+            self._clearLazy()
             return False
     
     def save(self):
@@ -430,22 +776,20 @@ class LaytonPack(Archive):
             writer.write(LaytonPack.MAGIC[self._version])
 
         for fileChunk in self.files:
-            header = binary.BinaryWriter()
-            data = binary.BinaryWriter()
-            data.writeString(fileChunk.name, ENCODING_DEFAULT_STRING)
+            # Metadata is written in place once the name and data lengths are known
+            offsetMetadata = writer.reserve(LaytonPack.METADATA_BLOCK_SIZE)
+            writer.writeString(fileChunk.name, ENCODING_DEFAULT_STRING)
             # TODO - General fix on null terminated strings! How did this go unnoticed??
-            data.write(b'\x00')
-
-            data.align(4)
-            header.writeU32(data.tell() + LaytonPack.METADATA_BLOCK_SIZE)
-            data.write(fileChunk.data)
-            data.dsAlign(4, 4)
-            header.writeU32(data.tell() + LaytonPack.METADATA_BLOCK_SIZE)
-            header.writeU32(0)
-            header.writeU32(len(fileChunk.data))
-            writer.write(header.data)
-            writer.write(data.data)
-        writer.insert(writer.tell().to_bytes(4, byteorder = 'little'), 4)
+            writer.write(b'\x00')
+
+            # Alignment is relative to the metadata block, which is itself 4-byte aligned
+            writer.align(4)
+            writer.writeU32At(writer.tell() - offsetMetadata, offsetMetadata)
+            writer.write(fileChunk.data)
+            writer.dsAlign(4, 4)
+            writer.writeU32At(writer.tell() - offsetMetadata, offsetMetadata + 4)
+            writer.writeU32At(len(fileChunk.data), offsetMetadata + 12)
+        writer.writeU32At(writer.tell(), 4)
         self.data = writer.data
 
 class LaytonPack2(Archive):
@@ -455,8 +799,18 @@ class LaytonPack2(Archive):
     def __init__(self, name=""):
         Archive.__init__(self, name=name)
     
-    def load(self, data):
-        reader = binary.BinaryReader(data = data)
+    def load(self, data, lazy=False):
+        """Loads archive contents.
+
+        Args:
+            data (bytearray): Archive data.
+            lazy (bool, optional): Only index members, serving them from data on demand with getFile. data must outlive the archive. Defaults to False.
+
+        Returns:
+            bool: True if the archive was loaded successfully.
+        """
+        self.close()
+        reader = binary.BinaryReader(data = data, zeroCopy = True)
         if reader.read(4) == b'LPC2':
             countFile = reader.readU32()
             offsetFile = reader.readU32()
@@ -472,44 +826,78 @@ class LaytonPack2(Archive):
 
                 reader.seek(offsetName + fileOffsetName)
                 tempName = reader.readNullTerminatedString(ENCODING_DEFAULT_STRING)
-                reader.seek(offsetFile + fileOffsetData)
-                tempData = reader.read(fileLengthData)
-                self.files.append(File(tempName, data=tempData))
+                if lazy:
+                    self._addLazyFile(tempName, offsetFile + fileOffsetData, fileLengthData)
+                else:
+                    reader.seek(offsetFile + fileOffsetData)
+                    tempData = reader.read(fileLengthData)
+                    self.files.append(File(tempName, data=tempData))
 
+            if lazy:
+                self._dataLazy = reader.data
             return True
 
         return False
     
     def save(self):
+        writer = binary.BinaryWriter()
+        self.saveToStream(writer)
+        self.data = writer.data
+
+    def saveToStream(self, dataOut) -> int:
+        """Writes the archive directly to a stream in a single pass over member data. Section offsets are computed from member sizes
+        beforehand, so nothing besides the names and metadata table is buffered.
+
+        Args:
+            dataOut (BinaryIO): Writable binary stream, e.g. an open file, mmap or BinaryWriter.
+
+        Returns:
+            int: Length of archive written in bytes.
+        """
+
+        def getDsAlignPadding(length : int) -> int:
+            # Matches BinaryWriter.dsAlign(4, 4)
+            padding = -length % 4
+            if padding == 0:
+                return 4
+            return padding
+
         metadata = binary.BinaryWriter()
         sectionName = binary.BinaryWriter()
-        sectionData = binary.BinaryWriter()
-        for fileIndex, fileChunk in enumerate(self.files):
+        lengthData = 0
+        for fileChunk in self.files:
             metadata.writeU32(sectionName.tell())
-            metadata.writeU32(sectionData.tell())
+            metadata.writeU32(lengthData)
             metadata.writeU32(len(fileChunk.data))
 
             sectionName.writeString(fileChunk.name, ENCODING_DEFAULT_STRING)
-            if fileIndex < len(self.files):
-                sectionName.write(b'\x00')
+            sectionName.write(b'\x00')
 
-            sectionData.write(fileChunk.data)
-            sectionData.dsAlign(4, 4)
+            lengthData += len(fileChunk.data)
+            lengthData += getDsAlignPadding(lengthData)
 
         sectionName.dsAlign(4, 4)
         
-        writer = binary.BinaryWriter()
-        writer.write(b'LPC2')
-        writer.writeU32(len(self.files))
-        writer.writeU32(LaytonPack2.HEADER_BLOCK_SIZE + metadata.tell() + sectionName.tell())
-        writer.writeU32(0) # EOFC, not written until end
-        writer.writeU32(LaytonPack2.HEADER_BLOCK_SIZE)
-        writer.writeU32(LaytonPack2.HEADER_BLOCK_SIZE + metadata.tell())
-        writer.writeU32(LaytonPack2.HEADER_BLOCK_SIZE + metadata.tell() + sectionName.tell())
-        writer.pad(LaytonPack2.HEADER_BLOCK_SIZE - writer.tell())
-        writer.write(metadata.data)
-        writer.write(sectionName.data)
-        writer.write(sectionData.data)
-        writer.insert(writer.tell().to_bytes(4, byteorder = 'little'), 12)
-
-        self.data = writer.data
\ No newline at end of file
+        offsetFile = LaytonPack2.HEADER_BLOCK_SIZE + metadata.tell() + sectionName.tell()
+        header = binary.BinaryWriter()
+        header.write(b'LPC2')
+        header.writeU32(len(self.files))
+        header.writeU32(offsetFile)
+        header.writeU32(offsetFile + lengthData)
+        header.writeU32(LaytonPack2.HEADER_BLOCK_SIZE)
+        header.writeU32(LaytonPack2.HEADER_BLOCK_SIZE + metadata.tell())
+        header.writeU32(offsetFile)
+        header.pad(LaytonPack2.HEADER_BLOCK_SIZE - header.tell())
+        dataOut.write(header.data)
+        dataOut.write(metadata.data)
+        dataOut.write(sectionName.data)
+
+        lengthData = 0
+        for fileChunk in self.files:
+            dataOut.write(fileChunk.data)
+            lengthData += len(fileChunk.data)
+            padding = getDsAlignPadding(lengthData)
+            dataOut.write(bytes(padding))
+            lengthData += padding
+        
+        return offsetFile + lengthData
\ No newline at end of file
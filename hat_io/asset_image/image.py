@@ -1,4 +1,5 @@
 from __future__ import annotations
+from concurrent.futures import Executor
 from typing import Callable, Dict, List, Optional, Tuple
 from PIL import Image
 from PIL.Image import Image as ImageType
@@ -139,7 +140,8 @@ class AnimatedImage():
         return animation
 
     @staticmethod
-    def _fromBytesArcArj(data : bytearray, functionGetFileByName : Optional[Callable[[str], Optional[bytearray]]], isArj : bool) -> AnimatedImage:
+    def _fromBytesArcArj(data : bytearray, functionGetFileByName : Optional[Callable[[str], Optional[bytearray]]], isArj : bool,
+                         executor : Optional[Executor] = None) -> AnimatedImage:
         output = AnimatedImage()
         workingAtlas = StaticImage()
         reader = binary.BinaryReader(data=data)
@@ -185,7 +187,7 @@ class AnimatedImage():
         output.atlases[atlasKey] = workingAtlas
         for indexImage in range(countSubImage):
             tempWorkingImages[indexImage].setPaletteFromList(palette, countColours=countColours)
-            workingAtlas.addImage(tempWorkingImages[indexImage].tilesToImage(tempWorkingImageResolutions[indexImage], useOffset=True))
+            workingAtlas.addImage(tempWorkingImages[indexImage].tilesToImage(tempWorkingImageResolutions[indexImage], useOffset=True, executor=executor))
             workingFrame = AnimationFrame()
             workingFrame.name = str(indexImage)
             workingFrame.dimensions = workingAtlas.getImage(indexImage).size
@@ -227,9 +229,10 @@ class AnimatedImage():
                 variableNames.append(name)
                 output.variables[name] = [0,0,0,0,0,0,0,0]
 
+            variableData = reader.readS16Array(8 * 16)
             for indexData in range(8):
                 for indexVariable in range(16):
-                    output.variables[variableNames[indexVariable]][indexData] = reader.readS16()
+                    output.variables[variableNames[indexVariable]][indexData] = variableData[indexData * 16 + indexVariable]
             
             offsetSubAnimationData = reader.tell()
             
@@ -241,15 +244,12 @@ class AnimatedImage():
                     try:
                         subAnimationData = functionGetFileByName(nameSubAnimation)
                         if subAnimationData != None:
-                            output.subAnimation = AnimatedImage.fromBytesArc(subAnimationData, functionGetFileByName=functionGetFileByName)
+                            output.subAnimation = AnimatedImage.fromBytesArc(subAnimationData, functionGetFileByName=functionGetFileByName, executor=executor)
                     except:
                         pass
 
                 reader.seek(offsetSubAnimationData)
-                tempOffset = [[],[]]
-                for indexDimension in range(2):
-                    for _indexOffset in range(countAnims):
-                        tempOffset[indexDimension].append(reader.readS16())
+                tempOffset = [reader.readS16Array(countAnims), reader.readS16Array(countAnims)]
                 for indexAnim in range(countAnims):
                     output.animations[indexAnim].subAnimationOffset = (tempOffset[0][indexAnim], tempOffset[1][indexAnim])
                     output.animations[indexAnim].subAnimationIndex = reader.readUInt(1)   
@@ -257,12 +257,14 @@ class AnimatedImage():
         return output
 
     @staticmethod
-    def fromBytesArc(data : bytearray, functionGetFileByName : Optional[Callable[[str], Optional[bytearray]]] = None) -> AnimatedImage:
-        return AnimatedImage._fromBytesArcArj(data, functionGetFileByName, False)
+    def fromBytesArc(data : bytearray, functionGetFileByName : Optional[Callable[[str], Optional[bytearray]]] = None,
+                     executor : Optional[Executor] = None) -> AnimatedImage:
+        return AnimatedImage._fromBytesArcArj(data, functionGetFileByName, False, executor=executor)
     
     @staticmethod
-    def fromBytesArj(data : bytearray, functionGetFileByName : Optional[Callable[[str], Optional[bytearray]]] = None) -> AnimatedImage:
-        return AnimatedImage._fromBytesArcArj(data, functionGetFileByName, True)
+    def fromBytesArj(data : bytearray, functionGetFileByName : Optional[Callable[[str], Optional[bytearray]]] = None,
+                     executor : Optional[Executor] = None) -> AnimatedImage:
+        return AnimatedImage._fromBytesArcArj(data, functionGetFileByName, True, executor=executor)
 
     @staticmethod
     def fromBytesArcHd(data : bytearray, atlas : ImageType, functionGetFileByName : Optional[Callable[[str], Tuple[bytes, Optional[ImageType]]]] = None) -> AnimatedImage:
@@ -322,9 +324,10 @@ class AnimatedImage():
                 variableNames.append(name)
                 output.variables[name] = [0,0,0,0,0,0,0,0]
 
+            variableData = reader.readS16Array(8 * 16)
             for indexData in range(8):
                 for indexVariable in range(16):
-                    output.variables[variableNames[indexVariable]][indexData] = reader.readS16()
+                    output.variables[variableNames[indexVariable]][indexData] = variableData[indexData * 16 + indexVariable]
             
             offsetSubAnimationData = reader.tell()
             if callable(functionGetFileByName):
@@ -337,10 +340,7 @@ class AnimatedImage():
                             output.subAnimation = AnimatedImage.fromBytesArcHd(subAnimationData, subAnimationImage, functionGetFileByName=functionGetFileByName)
 
                             reader.seek(offsetSubAnimationData)
-                            tempOffset = [[],[]]
-                            for indexDimension in range(2):
-                                for indexOffset in range(countAnim):
-                                    tempOffset[indexDimension].append(reader.readS16())
+                            tempOffset = [reader.readS16Array(countAnim), reader.readS16Array(countAnim)]
                             for indexAnim in range(countAnim):
                                 output.animations[indexAnim].subAnimationOffset = (tempOffset[0][indexAnim], tempOffset[1][indexAnim])
                                 output.animations[indexAnim].subAnimationIndex = reader.readUInt(1)
@@ -589,7 +589,7 @@ class StaticImage():
         return False
     
     @staticmethod
-    def fromBytesArc(data : bytearray) -> StaticImage:
+    def fromBytesArc(data : bytearray, executor : Optional[Executor] = None) -> StaticImage:
         output = StaticImage()
         reader = binary.BinaryReader(data=data)
         workingImage = TiledImageHandler()
@@ -597,15 +597,14 @@ class StaticImage():
         lengthPalette = reader.readU32()
         workingImage.setPaletteFromList(getPaletteAsListFromReader(reader, lengthPalette), countColours=lengthPalette)
         for index in range(reader.readU32()):
-            workingImage.addTileFromReader(reader, overrideBpp=8)
+            # Tiles are only left undecoded when there's an executor to decode them across
+            workingImage.addTileFromReader(reader, prolongDecoding=executor != None, overrideBpp=8)
         
         resolution = (reader.readU16() * 8, reader.readU16() * 8)
-        tileMap = {}
-        for index in range(int((resolution[0] * resolution[1]) // 64)):
-            tileMap[index] = reader.readU16()
+        tileMap = dict(enumerate(reader.readU16Array((resolution[0] * resolution[1]) // 64)))
 
         workingImage.setTileMap(tileMap)
-        output.addImage(workingImage.tilesToImage(resolution))
+        output.addImage(workingImage.tilesToImage(resolution, executor=executor))
         return output
     
     def toBytesArc(self) -> List[bytearray]:
@@ -638,7 +637,7 @@ class StaticImage():
         return tempOutput
 
     @staticmethod
-    def fromBytesLImg(data : bytearray) -> StaticImage:
+    def fromBytesLImg(data : bytearray, executor : Optional[Executor] = None) -> StaticImage:
         output = StaticImage()
         reader = binary.BinaryReader(data=data)
         if reader.read(4) == b'LIMG':
@@ -663,7 +662,7 @@ class StaticImage():
 
             reader.seek(offsetTile)
             for _index in range(countTile):
-                workingImage.addTileFromReader(reader)
+                workingImage.addTileFromReader(reader, prolongDecoding=executor != None)
             
             reader.seek(offsetTableTile)
             tileMap = {}
@@ -671,7 +670,7 @@ class StaticImage():
                 tileMap[index] = reader.readU16()
             workingImage.setTileMap(tileMap)
 
-            packedTexture = workingImage.tilesToImage(resolution)
+            packedTexture = workingImage.tilesToImage(resolution, executor=executor)
 
             reader.seek(offsetSubImageData)
             for _subImageCount in range(countSubImage):
@@ -1,14 +1,17 @@
 from __future__ import annotations
 
+from collections import OrderedDict
+from concurrent.futures import Executor
 from math import log
 from random import randint
 from PIL.Image import Image as ImageType
 from PIL import Image
+import numpy as np
 from typing import Dict, List, Optional, Tuple
 from ..colour import getPackedColourFromRgb888, getPaletteAsListFromReader
 from ..tiler import TiledImageHandler, Tile
 from ...binary import BinaryReader, BinaryWriter
-from ..paletting.alpha_helper import funcRejectPixelByThresholdingAlpha
+from ..paletting.alpha_helper import maskOpaqueByThresholdingAlpha
 from ..paletting.nds_bpc_helper import getConversionBasis
 from ..paletting.paletter import addToPalette, createPaletteFromImages
 from ..paletting.quantizer import quantize
@@ -104,6 +107,37 @@ class Animation():
         """
         return self.__name
     
+def _decodeFrame(tiles : TiledImageHandler, resolution : Tuple[int,int], executor : Optional[Executor] = None) -> Tuple[ImageType, ImageType, ImageType]:
+    # Returns paletted frame, RGB frame and alpha channel
+    frame = tiles.tilesToImage(resolution, useOffset=True, executor=executor)
+
+    # Index 0 is transparent, so split it into alpha and shift remaining colors down
+    pixels = np.asarray(frame)
+    isOpaque = pixels != 0
+    frameRgb = Image.fromarray(np.where(isOpaque[:, :, None], np.asarray(frame.convert("RGB")), 0).astype(np.uint8))
+    alpha = Image.frombytes("L", frame.size, np.where(isOpaque, 255, 0).astype(np.uint8).tobytes())
+    frame.frombytes(np.where(isOpaque, pixels - 1, 0).astype(np.uint8).tobytes())
+    
+    frame.putpalette(frame.getpalette()[3:])
+    return (frame, frameRgb, alpha)
+
+class _LazyFrame():
+    def __init__(self, tiles : TiledImageHandler, resolution : Tuple[int,int], paletteRgb : List[int], countColors : int):
+        # Undecoded frame kept from loading. Quantized output is the stored frame until the palette changes
+        self.tiles              : TiledImageHandler = tiles
+        self.resolution         : Tuple[int,int]    = resolution
+        self.paletteRgb         : List[int]         = paletteRgb
+        self.countColors        : int               = countColors
+        self.isPaletteSet       : bool              = False
+        self.isQuantizedValid   : bool              = True
+
+    def decode(self) -> Tuple[ImageType, ImageType, ImageType]:
+        # Palette setup is slow enough to matter when only metadata is needed, so is left until here too
+        if not(self.isPaletteSet):
+            self.tiles.setPaletteFromList(self.paletteRgb, countColours=self.countColors)
+            self.isPaletteSet = True
+        return _decodeFrame(self.tiles, self.resolution)
+
 class AnimatedEditableImage():
     """Editable representation for ARC and ARJ images. Alternative to madhatter.hat_io.asset_image.AnimatedImage with better usability and API.
     """
@@ -134,6 +168,11 @@ class AnimatedEditableImage():
         self.__framesColorTransforms    : List[ColorManagementController] = []
         self.__framesAlphaChannel       : List[Optional[ImageType]] = []
 
+        # Frames loaded lazily have None in the lists above until replaced. Decoded lazy frames are kept in a bounded cache
+        self.__framesLazy               : List[Optional[_LazyFrame]] = []
+        self.__framesDecoded            : OrderedDict[_LazyFrame, Tuple[ImageType, ImageType, ImageType]] = OrderedDict()
+        self.__maxDecodedFrames         : int = 0
+
         self.__animations   : List[Animation]           = []
         self.__variables    : Dict[str, List[int]]      = {}
         self.__nameSubAnimation : str   = ""
@@ -146,6 +185,42 @@ class AnimatedEditableImage():
         self.__framesQuantizedCache = []
         for frame in self.__frames:
             self.__framesQuantizedCache.append(None)
+        for lazy in self.__framesLazy:
+            if lazy != None:
+                lazy.isQuantizedValid = False
+
+    def __getDecodedFrame(self, lazy : _LazyFrame) -> Tuple[ImageType, ImageType, ImageType]:
+        if lazy in self.__framesDecoded:
+            self.__framesDecoded.move_to_end(lazy)
+            return self.__framesDecoded[lazy]
+        
+        decoded = lazy.decode()
+        self.__framesDecoded[lazy] = decoded
+        while len(self.__framesDecoded) > max(self.__maxDecodedFrames, 1):
+            self.__framesDecoded.popitem(last=False)
+        return decoded
+
+    def __getFrameAndAlpha(self, idxFrame : int) -> Tuple[ImageType, Optional[ImageType]]:
+        lazy = self.__framesLazy[idxFrame]
+        if lazy == None:
+            return (self.__frames[idxFrame], self.__framesAlphaChannel[idxFrame])
+        _quantized, frame, alpha = self.__getDecodedFrame(lazy)
+        return (frame, alpha)
+
+    def __getAllFramesAndAlpha(self) -> Tuple[List[ImageType], List[Optional[ImageType]]]:
+        frames = []
+        alphas = []
+        for idxFrame in range(len(self.__frames)):
+            frame, alpha = self.__getFrameAndAlpha(idxFrame)
+            frames.append(frame)
+            alphas.append(alpha)
+        return (frames, alphas)
+
+    def __dropLazyFrame(self, idxFrame : int):
+        lazy = self.__framesLazy[idxFrame]
+        if lazy != None:
+            self.__framesDecoded.pop(lazy, None)
+            self.__framesLazy[idxFrame] = None
         
     def getPalette(self) -> List[Tuple[float,float,float]]:
         """Returns a list of null-transformed tuples representing the colors stored in the palette.
@@ -177,30 +252,29 @@ class AnimatedEditableImage():
         This method is destructive to the original palette - all images are given equal priority in this process.
         """
         self.__invalidQuantizedCache()
-        funcAlpha = []
-        for alphaChannel in self.__framesAlphaChannel:
-            funcAlpha.append(funcRejectPixelByThresholdingAlpha(alphaChannel))
-        self.__palette = createPaletteFromImages(self.__frames, self.__framesColorTransforms, funcAlpha, maxColors=self.__maxColors)
+        frames, alphas = self.__getAllFramesAndAlpha()
+        maskAlpha = []
+        for alphaChannel in alphas:
+            maskAlpha.append(maskOpaqueByThresholdingAlpha(alphaChannel))
+        self.__palette = createPaletteFromImages(frames, self.__framesColorTransforms, maskAlpha, maxColors=self.__maxColors)
     
     def paletteCullUnused(self):
         """Removes unused colors from the palette. Quantizing operations are not guaranteed to use every color in the palette, so this operation may free space in the palette.
 
         This operation is non-destructive but will force paletted images to need to be recomputed, which is expensive.
         """
-        for idxFrame, quantized in enumerate(self.__framesQuantizedCache):
-            if quantized == None:
-                self.__getQuantizedFrameNoAlpha(idxFrame)
-
         usedPaletted : Dict[int, bool] = {}
         for idxColor in range(len(self.__palette)):
             usedPaletted[idxColor] = False
 
-        for quantized, alphaChannel in zip(self.__framesQuantizedCache, self.__framesAlphaChannel):
-            thresholdFunc = funcRejectPixelByThresholdingAlpha(alphaChannel)
-            for y in range(quantized.size[1]):
-                for x in range(quantized.size[0]):
-                    if alphaChannel == None or thresholdFunc((x,y)):
-                        usedPaletted[quantized.getpixel((x,y))] = True
+        for idxFrame in range(len(self.__frames)):
+            quantized = self.__getQuantizedFrameNoAlpha(idxFrame)
+            _frame, alphaChannel = self.__getFrameAndAlpha(idxFrame)
+            pixels = np.asarray(quantized)
+            if alphaChannel != None:
+                pixels = pixels[maskOpaqueByThresholdingAlpha(alphaChannel)]
+            for idxUsed in np.unique(pixels).tolist():
+                usedPaletted[idxUsed] = True
         
         # TODO - Remap quantized images using palCull. For now, we'll invalidate cache instead
         palCull : Dict[int,int] = {}
@@ -271,6 +345,7 @@ class AnimatedEditableImage():
         self.__framesQuantizedCache.append(None)
         self.__framesColorTransforms.append(transform)
         self.__framesAlphaChannel.append(alphaChannel)
+        self.__framesLazy.append(None)
         return output
 
     def addFrame(self, image : ImageType, alphaResolveImage : Optional[ImageType] = None, alphaResolvePos : Tuple[int,int] = (0,0), protectPalette : bool = True) -> int:
@@ -292,14 +367,15 @@ class AnimatedEditableImage():
         # TODO - Add multiple images variant
         convImage, alphaChannel = getConversionBasis(image, alphaResolveImage=alphaResolveImage, alphaPastePos=alphaResolvePos)
         transform = NullColorManagementController()
-        alphaFunc = funcRejectPixelByThresholdingAlpha(alphaChannel)
+        alphaMask = maskOpaqueByThresholdingAlpha(alphaChannel)
 
-        funcInternalAlpha = []
-        for alp in self.__framesAlphaChannel:
-            funcInternalAlpha.append(funcRejectPixelByThresholdingAlpha(alp))
+        frames, alphas = self.__getAllFramesAndAlpha()
+        maskInternalAlpha = []
+        for alp in alphas:
+            maskInternalAlpha.append(maskOpaqueByThresholdingAlpha(alp))
 
-        self.__palette = addToPalette(self.__frames, self.__framesColorTransforms, self.__palette, funcInternalAlpha,
-                                      [convImage], [transform], [alphaFunc],
+        self.__palette = addToPalette(frames, self.__framesColorTransforms, self.__palette, maskInternalAlpha,
+                                      [convImage], [transform], [alphaMask],
                                       maxColors=self.__maxColors, regenAllImageOnFail=not(protectPalette))
         self.__invalidQuantizedCache()
         output = len(self.__frames)
@@ -307,29 +383,30 @@ class AnimatedEditableImage():
         self.__framesQuantizedCache.append(None)
         self.__framesColorTransforms.append(transform)
         self.__framesAlphaChannel.append(alphaChannel)
+        self.__framesLazy.append(None)
         return output
     
     def __applyAlpha(self, image : ImageType, alphaChannel : Optional[ImageType]) -> ImageType:
         if alphaChannel == None:
             return image.copy()
-        alphaTest = funcRejectPixelByThresholdingAlpha(alphaChannel)
+        alphaMask = maskOpaqueByThresholdingAlpha(alphaChannel)
         image = image.convert("RGBA")
-        for y in range(image.size[1]):
-            for x in range(image.size[0]):
-                if not(alphaTest((x,y))):
-                    r,g,b,a = image.getpixel((x,y))
-                    image.putpixel((x,y), (r,g,b,0))
+        alpha = np.asarray(image.getchannel("A"))
+        image.putalpha(Image.frombytes("L", image.size, np.where(alphaMask, alpha, 0).astype(np.uint8).tobytes()))
         return image
 
     def __getQuantizedFrameNoAlpha(self, idxFrame : int) -> Optional[ImageType]:
         if 0 <= idxFrame < len(self.__frames):
             quantized = self.__framesQuantizedCache[idxFrame]
             if quantized == None:
-                frame = self.__frames[idxFrame]
+                lazy = self.__framesLazy[idxFrame]
+                if lazy != None and lazy.isQuantizedValid:
+                    return self.__getDecodedFrame(lazy)[0]
+
+                frame, alphaChannel = self.__getFrameAndAlpha(idxFrame)
                 transform = self.__framesColorTransforms[idxFrame]
-                alphaChannel = self.__framesAlphaChannel[idxFrame]
-                alphaFunc = funcRejectPixelByThresholdingAlpha(alphaChannel)
-                self.__framesQuantizedCache[idxFrame] = quantize(frame, self.__palette, transform, funcPixelAllowedError=alphaFunc)
+                alphaMask = maskOpaqueByThresholdingAlpha(alphaChannel)
+                self.__framesQuantizedCache[idxFrame] = quantize(frame, self.__palette, transform, maskPixelAllowedError=alphaMask)
             return self.__framesQuantizedCache[idxFrame]
         return None
 
@@ -346,7 +423,7 @@ class AnimatedEditableImage():
         image = self.__getQuantizedFrameNoAlpha(idxFrame)
         if image == None:
             return None
-        return self.__applyAlpha(image, self.__framesAlphaChannel[idxFrame])
+        return self.__applyAlpha(image, self.__getFrameAndAlpha(idxFrame)[1])
 
     def getRawFrame(self, idxFrame : int) -> Optional[Tuple[ImageType, Optional[ImageType], ColorManagementController]]:
         """Returns a copy of the image as stored internally. This means that colors may exceed the capabilities of the DS.
@@ -359,9 +436,10 @@ class AnimatedEditableImage():
             Optional[Tuple[ImageType, Optional[ImageType], ColorManagementController]]: A copy of the image alongside its alpha channel and color management data.
         """
         if 0 <= idxFrame < len(self.__frames):
-            if self.__framesAlphaChannel[idxFrame] == None:
-                return (self.__frames[idxFrame].copy(), None, self.__framesColorTransforms[idxFrame])
-            return (self.__frames[idxFrame].copy(), self.__framesAlphaChannel[idxFrame].copy(), self.__framesColorTransforms[idxFrame])
+            frame, alphaChannel = self.__getFrameAndAlpha(idxFrame)
+            if alphaChannel == None:
+                return (frame.copy(), None, self.__framesColorTransforms[idxFrame])
+            return (frame.copy(), alphaChannel.copy(), self.__framesColorTransforms[idxFrame])
         return None
 
     def getRawFrameAlphaPreintegrated(self, idxFrame : int) -> Optional[Tuple[ImageType, ColorManagementController]]:
@@ -400,6 +478,7 @@ class AnimatedEditableImage():
             return False
         
         assert frame.mode == "RGB"
+        self.__dropLazyFrame(idxFrame)
         self.__framesQuantizedCache[idxFrame] = None
         self.__frames[idxFrame] = frame
         self.__framesAlphaChannel[idxFrame] = alpha
@@ -462,6 +541,8 @@ class AnimatedEditableImage():
                 else:
                     animation.keyframes.remove(keyframe)
 
+        self.__dropLazyFrame(idxFrame)
+        self.__framesLazy.pop(idxFrame)
         self.__frames.pop(idxFrame)
         self.__framesAlphaChannel.pop(idxFrame)
         self.__framesColorTransforms.pop(idxFrame)
@@ -725,7 +806,7 @@ class AnimatedEditableImage():
         return self.__sourceWasArj
 
     @staticmethod
-    def __fromBytesArcArj(data : bytes, isArj : bool = False) -> AnimatedEditableImage:
+    def __fromBytesArcArj(data : bytes, isArj : bool = False, lazy : bool = False, maxDecodedFrames : int = 8, executor : Optional[Executor] = None) -> AnimatedEditableImage:
         # TODO - Rewrite this, ported from old library
         output = AnimatedEditableImage()
         reader = BinaryReader(data=data)
@@ -763,29 +844,22 @@ class AnimatedEditableImage():
             countColors = reader.readU32()
 
         paletteRgb = getPaletteAsListFromReader(reader, countColors)
+        output.__maxDecodedFrames = maxDecodedFrames
         for indexImage in range(countFrames):
-            workingFrames[indexImage].setPaletteFromList(paletteRgb, countColours=countColors)
-            
-            frame = workingFrames[indexImage].tilesToImage(workingFrameResolutions[indexImage], useOffset=True)
-            frameRgb = frame.copy().convert("RGB")
-            alpha = Image.new("L", frame.size)
-            
-            for y in range(frame.size[1]):
-                for x in range(frame.size[0]):
-                    idxPal = frame.getpixel((x,y))
-                    if idxPal == 0:
-                        # Transparent
-                        frameRgb.putpixel((x,y), (0,0,0))
-                        alpha.putpixel((x,y), 0)
-                    else:
-                        frame.putpixel((x,y), max(0, idxPal - 1))
-                        alpha.putpixel((x,y), 255)
-            
-            frame.putpalette(frame.getpalette()[3:])
-            output.__frames.append(frameRgb)
-            output.__framesQuantizedCache.append(frame)
             output.__framesColorTransforms.append(NullColorManagementController())
-            output.__framesAlphaChannel.append(alpha)
+
+            if lazy:
+                output.__frames.append(None)
+                output.__framesQuantizedCache.append(None)
+                output.__framesAlphaChannel.append(None)
+                output.__framesLazy.append(_LazyFrame(workingFrames[indexImage], workingFrameResolutions[indexImage], paletteRgb, countColors))
+            else:
+                workingFrames[indexImage].setPaletteFromList(paletteRgb, countColours=countColors)
+                frame, frameRgb, alpha = _decodeFrame(workingFrames[indexImage], workingFrameResolutions[indexImage], executor=executor)
+                output.__frames.append(frameRgb)
+                output.__framesQuantizedCache.append(frame)
+                output.__framesAlphaChannel.append(alpha)
+                output.__framesLazy.append(None)
         
         paletteRgb = paletteRgb[3:]
         paletteNull : List[Tuple[float,float,float]] = []
@@ -827,14 +901,12 @@ class AnimatedEditableImage():
                 name = reader.readPaddedString(16, ENCODING_DEFAULT_STRING)
                 varKeys.append(name)
                 output.__variables[name] = [0,0,0,0,0,0,0,0]
+            variableData = reader.readS16Array(8 * 16)
             for indexData in range(8):
                 for indexVariable in range(16):
-                    output.__variables[varKeys[indexVariable]][indexData] = reader.readS16()
+                    output.__variables[varKeys[indexVariable]][indexData] = variableData[indexData * 16 + indexVariable]
             
-            tempOffset = [[],[]]
-            for indexDimension in range(2):
-                for indexOffset in range(countAnims):
-                    tempOffset[indexDimension].append(reader.readS16())
+            tempOffset = [reader.readS16Array(countAnims), reader.readS16Array(countAnims)]
             for indexAnim in range(countAnims):
                 output.__animations[indexAnim].offsetSubAnimation = (tempOffset[0][indexAnim], tempOffset[1][indexAnim])
                 output.__animations[indexAnim].idxSubAnimation = reader.readUInt(1)
@@ -845,30 +917,36 @@ class AnimatedEditableImage():
         return output
     
     @staticmethod
-    def fromBytesArc(data : bytes) -> AnimatedEditableImage:
+    def fromBytesArc(data : bytes, lazy : bool = False, maxDecodedFrames : int = 8, executor : Optional[Executor] = None) -> AnimatedEditableImage:
         """Creates an image representation from decompressed NDS ARC bytes.
         This method may throw an error if the image is formatted improperly.
 
         Args:
             data (bytes): Decompressed NDS ARC bytes.
+            lazy (bool, optional): Only decode frames when they are first needed. Animations and variables are available immediately. Defaults to False.
+            maxDecodedFrames (int, optional): Decoded frames kept in memory in lazy mode. Frames that haven't been modified are decoded again if evicted. Defaults to 8.
+            executor (Optional[Executor], optional): Executor to split tile decoding across while loading, e.g. a ThreadPoolExecutor or ProcessPoolExecutor shared between images. Frames decoded later in lazy mode don't use it. Defaults to None.
 
         Returns:
             AnimatedEditableImage: Image representation.
         """
-        return AnimatedEditableImage.__fromBytesArcArj(data, isArj = False)
+        return AnimatedEditableImage.__fromBytesArcArj(data, isArj = False, lazy = lazy, maxDecodedFrames = maxDecodedFrames, executor = executor)
 
     @staticmethod
-    def fromBytesArj(data : bytes) -> AnimatedEditableImage:
+    def fromBytesArj(data : bytes, lazy : bool = False, maxDecodedFrames : int = 8, executor : Optional[Executor] = None) -> AnimatedEditableImage:
         """Creates an image representation from decompressed NDS ARJ bytes.
         This method may throw an error if the image is formatted improperly.
 
         Args:
             data (bytes): Decompressed NDS ARJ bytes.
+            lazy (bool, optional): Only decode frames when they are first needed. Animations and variables are available immediately. Defaults to False.
+            maxDecodedFrames (int, optional): Decoded frames kept in memory in lazy mode. Frames that haven't been modified are decoded again if evicted. Defaults to 8.
+            executor (Optional[Executor], optional): Executor to split tile decoding across while loading, e.g. a ThreadPoolExecutor or ProcessPoolExecutor shared between images. Frames decoded later in lazy mode don't use it. Defaults to None.
 
         Returns:
             AnimatedEditableImage: Image representation.
         """
-        return AnimatedEditableImage.__fromBytesArcArj(data, isArj = True)
+        return AnimatedEditableImage.__fromBytesArcArj(data, isArj = True, lazy = lazy, maxDecodedFrames = maxDecodedFrames, executor = executor)
 
     def __toBytesArcArj(self, remapCustomAnimFrames : bool = True, exportVariables : bool = True, isArj : bool = False) -> bytearray:
         # TODO - Rewrite this, currently ported from old library
@@ -912,21 +990,25 @@ class AnimatedEditableImage():
             outputImages : List[ImageType] = []
 
             # Quantize remaining frames
-            for idxFrame, alphaChannel in zip(range(len(self.__frames)), self.__framesAlphaChannel):
+            for idxFrame in range(len(self.__frames)):
 
-                funcCheckAlpha = funcRejectPixelByThresholdingAlpha(alphaChannel)
+                alphaMask = maskOpaqueByThresholdingAlpha(self.__getFrameAndAlpha(idxFrame)[1])
                 image = self.__getQuantizedFrameNoAlpha(idxFrame).copy()
-
-                for y in range(image.size[1]):
-                    for x in range(image.size[0]):
-                        idxUsed = image.getpixel((x,y))
-                        if funcCheckAlpha == None or funcCheckAlpha((x,y)):
-                            if idxUsed not in paletteMap:
-                                paletteMap[idxUsed] = len(palette)
-                                palette.append(rawPalette[idxUsed])
-                            image.putpixel((x,y), paletteMap[idxUsed])
-                        else:
-                            image.putpixel((x,y), 0)
+                pixels = np.asarray(image)
+                if alphaMask is None:
+                    alphaMask = np.ones(pixels.shape, dtype=bool)
+
+                # Map colors in order of first use, keeping index 0 for transparency
+                usedOrdered, idxFirstUse = np.unique(pixels[alphaMask], return_index=True)
+                for idxUsed in usedOrdered[np.argsort(idxFirstUse)].tolist():
+                    if idxUsed not in paletteMap:
+                        paletteMap[idxUsed] = len(palette)
+                        palette.append(rawPalette[idxUsed])
+                
+                lookupMap = np.zeros(256, dtype=np.uint8)
+                for idxUsed, idxMapped in paletteMap.items():
+                    lookupMap[idxUsed] = idxMapped
+                image.frombytes(np.where(alphaMask, lookupMap[pixels], 0).astype(np.uint8).tobytes())
 
                 outputImages.append(image)
             
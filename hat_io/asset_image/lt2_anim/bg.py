@@ -1,11 +1,13 @@
 from __future__ import annotations
+from concurrent.futures import Executor
 from random import randint
 
 from typing import List, Optional, Tuple
 from PIL.Image import Image as ImageType
 from PIL import Image
+import numpy as np
 from ..colour import getPackedColourFromRgb888, getPaletteAsListFromReader
-from ..paletting.alpha_helper import funcRejectPixelByThresholdingAlpha
+from ..paletting.alpha_helper import maskOpaqueByThresholdingAlpha
 from ..paletting.const import PREPROCESS_DITHER
 
 from ..paletting.nds_bpc_helper import getConversionBasis
@@ -60,11 +62,12 @@ class EditableBackground():
         return output
 
     @staticmethod
-    def fromBytes(data : bytes) -> EditableBackground:
+    def fromBytes(data : bytes, executor : Optional[Executor] = None) -> EditableBackground:
         """Creates a background from a decompressed ARC background file chunk.
 
         Args:
             data (bytes): Decompressed ARC background file chunk.
+            executor (Optional[Executor], optional): Executor to split tile decoding across, e.g. a ThreadPoolExecutor or ProcessPoolExecutor shared between images. Defaults to None.
 
         Returns:
             EditableBackground: Background image representation.
@@ -76,28 +79,23 @@ class EditableBackground():
         lengthPalette = reader.readU32()
         workingImage.setPaletteFromList(getPaletteAsListFromReader(reader, lengthPalette), countColours=lengthPalette)
         for index in range(reader.readU32()):
-            workingImage.addTileFromReader(reader, overrideBpp=8)
+            # Tiles are only left undecoded when there's an executor to decode them across
+            workingImage.addTileFromReader(reader, prolongDecoding=executor != None, overrideBpp=8)
         
         resolution = (reader.readU16() * 8, reader.readU16() * 8)
-        tileMap = {}
-        for index in range(int((resolution[0] * resolution[1]) // 64)):
-            tileMap[index] = reader.readU16()
+        tileMap = dict(enumerate(reader.readU16Array((resolution[0] * resolution[1]) // 64)))
 
         workingImage.setTileMap(tileMap)
 
-        quantized = workingImage.tilesToImage(resolution)
+        quantized = workingImage.tilesToImage(resolution, executor=executor)
         alphaChannel = None
 
         if lengthPalette > 0:
-            alphaChannel = Image.new("L", resolution, 0)
-            for y in range(resolution[1]):
-                for x in range(resolution[0]):
-                    pixel = quantized.getpixel((x,y))
-                    if pixel == 0:
-                        alphaChannel.putpixel((x,y), 0)
-                    else:
-                        alphaChannel.putpixel((x,y), 255)
-                        quantized.putpixel((x,y), pixel - 1)
+            # Index 0 is transparent, so split it into alpha and shift remaining colors down
+            pixels = np.asarray(quantized)
+            isOpaque = pixels != 0
+            alphaChannel = Image.frombytes("L", quantized.size, np.where(isOpaque, 255, 0).astype(np.uint8).tobytes())
+            quantized.frombytes(np.where(isOpaque, pixels - 1, 0).astype(np.uint8).tobytes())
             quantized.putpalette(quantized.getpalette()[3:])
         
             output.__maxColors = lengthPalette - 1
@@ -149,8 +147,8 @@ class EditableBackground():
         if self.__imageRaw == None:
             return
         
-        alphaFunc = funcRejectPixelByThresholdingAlpha(self.__imageAlpha)
-        self.__palette = generate5BitEncodedPalette(self.__imageRaw, self.__colorManagement, funcPixelAllowedInPalette=alphaFunc, maxColors=self.__maxColors, thresholdCloseColors=threshold)
+        alphaMask = maskOpaqueByThresholdingAlpha(self.__imageAlpha)
+        self.__palette = generate5BitEncodedPalette(self.__imageRaw, self.__colorManagement, maxColors=self.__maxColors, thresholdCloseColors=threshold, maskPixelAllowedInPalette=alphaMask)
         self.__imageQuantized = None
 
     def paletteSetOverride(self, overridePaletteLinRgb : List[Tuple[float,float,float]]):
@@ -180,8 +178,8 @@ class EditableBackground():
             if self.__imageRaw == None or self.__palette == []:
                 return None
             
-            alphaFunc = funcRejectPixelByThresholdingAlpha(self.__imageAlpha)
-            self.__imageQuantized = quantize(self.__imageRaw, self.__palette, self.__colorManagement, funcPixelAllowedError=alphaFunc)
+            alphaMask = maskOpaqueByThresholdingAlpha(self.__imageAlpha)
+            self.__imageQuantized = quantize(self.__imageRaw, self.__palette, self.__colorManagement, maskPixelAllowedError=alphaMask)
         return self.__imageQuantized
     
     def setImage(self, image : ImageType, alphaResolveImage : Optional[ImageType] = None, alphaResolvePos : Tuple[int,int] = (0,0), preprocessMode : int = PREPROCESS_DITHER):
@@ -200,6 +198,11 @@ class EditableBackground():
         self.__imageRaw = basis
         self.__imageAlpha = alpha
     
+    def __applyThresholdedAlpha(self, rgbSource : ImageType):
+        alphaMask = maskOpaqueByThresholdingAlpha(self.__imageAlpha)
+        if alphaMask is not None:
+            rgbSource.putalpha(Image.frombytes("L", rgbSource.size, np.where(alphaMask, 255, 0).astype(np.uint8).tobytes()))
+
     def getRawImage(self) -> Optional[ImageType]:
         """Returns a copy of the non-paletted image. This refers to the source image so may exceed the capabilities of the NDS. Transparency is pre-applied.
 
@@ -212,16 +215,7 @@ class EditableBackground():
             return None
 
         rgbSource = self.__imageRaw.convert("RGBA")
-        if self.__imageAlpha != None:
-            funcAlpha = funcRejectPixelByThresholdingAlpha(self.__imageAlpha)
-            for y in range(rgbSource.size[1]):
-                for x in range(rgbSource.size[0]):
-                    r,g,b,a = rgbSource.getpixel((x,y))
-                    if funcAlpha((x,y)):
-                        a = 255
-                    else:
-                        a = 0
-                    rgbSource.putpixel((x,y), (r,g,b,a))
+        self.__applyThresholdedAlpha(rgbSource)
         return rgbSource
 
     def getQuantizedImage(self) -> Optional[ImageType]:
@@ -239,16 +233,7 @@ class EditableBackground():
             return Image.new("RGBA", (256,192), (255,255,255,0))
         else:
             rgbSource = quantized.convert("RGBA")
-            if self.__imageAlpha != None:
-                funcAlpha = funcRejectPixelByThresholdingAlpha(self.__imageAlpha)
-                for y in range(rgbSource.size[1]):
-                    for x in range(rgbSource.size[0]):
-                        r,g,b,a = rgbSource.getpixel((x,y))
-                        if funcAlpha((x,y)):
-                            a = 255
-                        else:
-                            a = 0
-                        rgbSource.putpixel((x,y), (r,g,b,a))
+            self.__applyThresholdedAlpha(rgbSource)
             return rgbSource
 
     def toBytes(self) -> Optional[bytearray]:
@@ -271,14 +256,13 @@ class EditableBackground():
                 return None
         else:
             exportImage = quantized.copy()
-            funcAlpha = funcRejectPixelByThresholdingAlpha(self.__imageAlpha)
+            alphaMask = maskOpaqueByThresholdingAlpha(self.__imageAlpha)
             # TODO - Remove unused colors
-            for y in range(exportImage.size[1]):
-                for x in range(exportImage.size[0]):
-                    if funcAlpha == None or funcAlpha((x,y)):
-                        exportImage.putpixel((x,y), exportImage.getpixel((x,y)) + 1)
-                    else:
-                        exportImage.putpixel((x,y), 0)
+            # Shift colors up to make room for transparency at index 0
+            pixels = np.asarray(exportImage).astype(np.uint8) + 1
+            if alphaMask is not None:
+                pixels = np.where(alphaMask, pixels, 0).astype(np.uint8)
+            exportImage.frombytes(pixels.tobytes())
         
             def getTransparencyColor(exportImage : ImageType) -> Tuple[int,int,int]:
 
@@ -1,5 +1,6 @@
-from typing import Optional, Callable, Tuple
+from typing import Optional, Callable, Tuple, Union
 from PIL.Image import Image as ImageType
+import numpy as np
 
 def funcRejectPixelByThresholdingAlpha(alphaChannel : Optional[ImageType], threshold : int = 127) -> Optional[Callable[[Tuple[int,int]], bool]]:
     """Returns a function for alpha thresholding based on the alpha channel. Pixels with alpha above the threshold are considered opaque, so will return True.
@@ -15,4 +16,37 @@ def funcRejectPixelByThresholdingAlpha(alphaChannel : Optional[ImageType], thres
         def funcThresholdAlpha(pos : Tuple[int,int]) -> bool:
             return alphaChannel.getpixel(pos) > threshold
         return funcThresholdAlpha
-    return None
\ No newline at end of file
+    return None
+
+def maskOpaqueByThresholdingAlpha(alphaChannel : Optional[ImageType], threshold : int = 127) -> Optional[np.ndarray]:
+    """Returns a mask for alpha thresholding based on the alpha channel. Pixels with alpha above the threshold are considered opaque, so will be True.
+
+    This matches funcRejectPixelByThresholdingAlpha but is computed once for the whole image, so can be used without per-pixel calls.
+
+    Args:
+        alphaChannel (Optional[ImageType]): Alpha channel as image. Should be in L mode or will be rejected.
+        threshold (int, optional): Minimum threshold (value itself excluded) where pixels are considered opaque. Defaults to 127.
+
+    Returns:
+        Optional[np.ndarray]: Boolean array of shape (height, width). If inputs were invalid, returns None.
+    """
+    if alphaChannel != None and alphaChannel.mode == "L":
+        return np.asarray(alphaChannel) > threshold
+    return None
+
+def getMaskFromPixelAllowed(pixelAllowed : Optional[Union[Callable[[Tuple[int,int]], bool], np.ndarray]], resolution : Tuple[int,int]) -> Optional[np.ndarray]:
+    """Converts a per-pixel allow function into a mask. Masks are passed through unchanged.
+
+    Args:
+        pixelAllowed (Optional[Union[Callable[[Tuple[int,int]], bool], np.ndarray]]): Function returning True for allowed pixels, or boolean array of shape (height, width).
+        resolution (Tuple[int,int]): Resolution of image as (width, height).
+
+    Returns:
+        Optional[np.ndarray]: Boolean array of shape (height, width), True where pixels are allowed. If no function or mask was given, returns None.
+    """
+    if pixelAllowed is None:
+        return None
+    if isinstance(pixelAllowed, np.ndarray):
+        assert pixelAllowed.shape == (resolution[1], resolution[0])
+        return pixelAllowed.astype(bool, copy=False)
+    return np.array([[bool(pixelAllowed((x,y))) for x in range(resolution[0])] for y in range(resolution[1])], dtype=bool).reshape(resolution[1], resolution[0])
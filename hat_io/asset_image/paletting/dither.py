@@ -1,9 +1,14 @@
-from typing import Optional, Tuple, Callable
+from typing import List, Optional, Tuple, Callable
 import numpy as np
 
 def _bypassRejection(coord : Tuple[int,int]) -> bool:
     return False
 
+def _getFuncRejectFromMask(maskRejectPixel : np.ndarray) -> Callable[[Tuple[int,int]], bool]:
+    def funcRejectPixel(coord : Tuple[int,int]) -> bool:
+        return bool(maskRejectPixel[coord[1], coord[0]])
+    return funcRejectPixel
+
 def _applyError(image : np.ndarray, error : np.ndarray, coord : Tuple[int,int], coefficient : float, funcRejectPixel : Callable[[Tuple[int,int]], bool]):
     if 0 <= coord[0] < image.shape[1] and 0 <= coord[1] < image.shape[0]:
         if not(funcRejectPixel(coord)):
@@ -41,32 +46,127 @@ def errorCorrectionDithering(image : np.ndarray, funcGetClosestColor : Callable[
     
     return image
 
-def floydSteinbergDither(image : np.ndarray, funcGetClosestColor : Callable[[np.ndarray], np.ndarray], funcRejectPixel : Optional[Callable[[Tuple[int,int]], bool]] = None) -> np.ndarray:
+def floydSteinbergDither(image : np.ndarray, funcGetClosestColor : Callable[[np.ndarray], np.ndarray], funcRejectPixel : Optional[Callable[[Tuple[int,int]], bool]] = None,
+                         maskRejectPixel : Optional[np.ndarray] = None) -> np.ndarray:
     """Applies Floyd-Steinberg error-diffusion dithering on an input image array. This provides good gradation with medium chance of stray pixels in long gradations.
 
     Args:
         image (np.ndarray): Input image formatted as array.
         funcGetClosestColor (Callable[[np.ndarray], np.ndarray]): Function to return closest color. Color returned should be in same space (and therefore scale) as image.
         funcRejectPixel (Optional[Callable[[Tuple[int,int]], bool]], optional): Function to prevent dithering at certain pixels. This will set pixels to the closest color and throw away their error if the function returns False. Defaults to None.
+        maskRejectPixel (Optional[np.ndarray], optional): Boolean array matching image dimensions. Pixels set to True don't receive error. Used instead of funcRejectPixel if given. Defaults to None.
 
     Returns:
         np.ndarray: Output image, dereferenced from original.
     """
-    if funcRejectPixel == None:
+    if maskRejectPixel is not None:
+        funcRejectPixel = _getFuncRejectFromMask(maskRejectPixel)
+    elif funcRejectPixel == None:
         funcRejectPixel = _bypassRejection
     return errorCorrectionDithering(image, funcGetClosestColor, distributeErrorFloydSteinberg, funcRejectPixel)
 
-def atkinsonDither(image : np.ndarray, funcGetClosestColor : Callable[[np.ndarray], np.ndarray], funcRejectPixel : Optional[Callable[[Tuple[int,int]], bool]] = None) -> np.ndarray:
+def atkinsonDither(image : np.ndarray, funcGetClosestColor : Callable[[np.ndarray], np.ndarray], funcRejectPixel : Optional[Callable[[Tuple[int,int]], bool]] = None,
+                   maskRejectPixel : Optional[np.ndarray] = None) -> np.ndarray:
     """Applies Atkinson error-diffusion dithering on an input image array. This provides okay gradation with low chance of stray pixels in long gradations.
 
     Args:
         image (np.ndarray): Input image formatted as array.
         funcGetClosestColor (Callable[[np.ndarray], np.ndarray]): Function to return closest color. Color returned should be in same space (and therefore scale) as image.
         funcRejectPixel (Optional[Callable[[Tuple[int,int]], bool]], optional): Function to prevent dithering at certain pixels. This will set pixels to the closest color and throw away their error if the function returns False. Defaults to None.
+        maskRejectPixel (Optional[np.ndarray], optional): Boolean array matching image dimensions. Pixels set to True don't receive error. Used instead of funcRejectPixel if given. Defaults to None.
 
     Returns:
         np.ndarray: Output image as array, dereferenced from original.
     """
-    if funcRejectPixel == None:
+    if maskRejectPixel is not None:
+        funcRejectPixel = _getFuncRejectFromMask(maskRejectPixel)
+    elif funcRejectPixel == None:
         funcRejectPixel = _bypassRejection
-    return errorCorrectionDithering(image, funcGetClosestColor, distributeErrorAtkinson, funcRejectPixel)
\ No newline at end of file
+    return errorCorrectionDithering(image, funcGetClosestColor, distributeErrorAtkinson, funcRejectPixel)
+
+KERNEL_FLOYD_STEINBERG  : List[Tuple[int,int,float]] = [(1, 0, 7/16), (-1, 1, 3/16), (0, 1, 5/16), (1, 1, 1/16)]
+KERNEL_ATKINSON         : List[Tuple[int,int,float]] = [(1, 0, 1/8), (2, 0, 1/8), (-1, 1, 1/8), (0, 1, 1/8), (1, 1, 1/8), (0, 2, 1/8)]
+
+def errorCorrectionDitheringVectorised(image : np.ndarray, funcGetClosestColors : Callable[[np.ndarray], np.ndarray], kernel : List[Tuple[int,int,float]],
+                                       maskRejectPixel : Optional[np.ndarray] = None) -> np.ndarray:
+    """Applies error-diffusion dithering, quantizing many pixels at once. Gives the same output as errorCorrectionDithering.
+
+    Pixels are processed in diagonal wavefronts where no pixel depends on the error of another in the same wavefront. Each wavefront is
+    quantized in one call and its error is spread with array operations. The wavefront slope is chosen so each pixel receives error in the
+    same order as a scanline pass, so rounding matches.
+
+    Args:
+        image (np.ndarray): Input image formatted as array.
+        funcGetClosestColors (Callable[[np.ndarray], np.ndarray]): Function to return the closest color for each row of an (n, channels) array.
+        kernel (List[Tuple[int,int,float]]): Error distribution as (x offset, y offset, coefficient), e.g. KERNEL_FLOYD_STEINBERG.
+        maskRejectPixel (Optional[np.ndarray], optional): Boolean array matching image dimensions. Pixels set to True don't receive error. Defaults to None.
+
+    Returns:
+        np.ndarray: Output image as array, dereferenced from original.
+    """
+    image = image.astype(np.float32)
+    height, width = image.shape[:2]
+
+    # Smallest slope so every pixel that passes error to another is in an earlier wavefront
+    slope = 1
+    for offsetX, offsetY, _coefficient in kernel:
+        if offsetY > 0:
+            slope = max(slope, (-offsetX // offsetY) + 1)
+    # Error must also reach each pixel in scanline order of its sources or float rounding differs. A source on an earlier row can't be in
+    #     a later wavefront than one on a later row, so steepen the slope until that holds for every pair of taps
+    for offsetXEarly, offsetYEarly, _coefficient in kernel:
+        for offsetXLate, offsetYLate, _coefficient in kernel:
+            if offsetYEarly > offsetYLate:
+                slope = max(slope, -(-(offsetXLate - offsetXEarly) // (offsetYEarly - offsetYLate)))
+    # Within a wavefront, sources further up were applied earlier in a scanline pass
+    kernel = sorted(kernel, key=lambda entry: (-entry[1], -entry[0]))
+
+    for indexWavefront in range(width + slope * (height - 1)):
+        ys = np.arange(max(0, -((width - 1 - indexWavefront) // slope)), min(height - 1, indexWavefront // slope) + 1)
+        if ys.size == 0:
+            continue
+        xs = indexWavefront - slope * ys
+
+        oldPixels = image[ys, xs]
+        newPixels = funcGetClosestColors(oldPixels)
+        image[ys, xs] = newPixels
+        error = oldPixels - newPixels
+
+        for offsetX, offsetY, coefficient in kernel:
+            targetX = xs + offsetX
+            targetY = ys + offsetY
+            isValid = (targetX >= 0) & (targetX < width) & (targetY < height)
+            if maskRejectPixel is not None:
+                isValid[isValid] = np.logical_not(maskRejectPixel[targetY[isValid], targetX[isValid]])
+            if np.any(isValid):
+                targetX = targetX[isValid]
+                targetY = targetY[isValid]
+                image[targetY, targetX] = image[targetY, targetX] + error[isValid] * coefficient
+    
+    return image
+
+def floydSteinbergDitherVectorised(image : np.ndarray, funcGetClosestColors : Callable[[np.ndarray], np.ndarray], maskRejectPixel : Optional[np.ndarray] = None) -> np.ndarray:
+    """Applies Floyd-Steinberg error-diffusion dithering on an input image array, quantizing many pixels at once. Output matches floydSteinbergDither.
+
+    Args:
+        image (np.ndarray): Input image formatted as array.
+        funcGetClosestColors (Callable[[np.ndarray], np.ndarray]): Function to return closest color for each row of an (n, channels) array. Colors returned should be in same space (and therefore scale) as image.
+        maskRejectPixel (Optional[np.ndarray], optional): Boolean array matching image dimensions. Pixels set to True are set to the closest color without receiving error. Defaults to None.
+
+    Returns:
+        np.ndarray: Output image as array, dereferenced from original.
+    """
+    return errorCorrectionDitheringVectorised(image, funcGetClosestColors, KERNEL_FLOYD_STEINBERG, maskRejectPixel)
+
+def atkinsonDitherVectorised(image : np.ndarray, funcGetClosestColors : Callable[[np.ndarray], np.ndarray], maskRejectPixel : Optional[np.ndarray] = None) -> np.ndarray:
+    """Applies Atkinson error-diffusion dithering on an input image array, quantizing many pixels at once. Output matches atkinsonDither.
+
+    Args:
+        image (np.ndarray): Input image formatted as array.
+        funcGetClosestColors (Callable[[np.ndarray], np.ndarray]): Function to return closest color for each row of an (n, channels) array. Colors returned should be in same space (and therefore scale) as image.
+        maskRejectPixel (Optional[np.ndarray], optional): Boolean array matching image dimensions. Pixels set to True are set to the closest color without receiving error. Defaults to None.
+
+    Returns:
+        np.ndarray: Output image as array, dereferenced from original.
+    """
+    return errorCorrectionDitheringVectorised(image, funcGetClosestColors, KERNEL_ATKINSON, maskRejectPixel)
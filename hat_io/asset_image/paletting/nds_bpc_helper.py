@@ -2,7 +2,7 @@ from typing import Optional, Tuple
 import numpy as np
 from PIL.Image import Image as ImageType
 from PIL import Image
-from .dither import floydSteinbergDither
+from .dither import floydSteinbergDitherVectorised
 from .const import PREPROCESS_DITHER, PREPROCESS_NONE, PREPROCESS_SCALE
 
 def ditherTo5bpc(image : ImageType, inBpp : int = 8) -> ImageType:
@@ -21,7 +21,7 @@ def ditherTo5bpc(image : ImageType, inBpp : int = 8) -> ImageType:
         return val
 
     # TODO - Atkinson dithering does provide slightly more contrast, although leans closer to banding
-    return Image.fromarray(floydSteinbergDither(np.asarray(image).astype(np.float32), getClosest5bitEquivalentColor).astype(np.uint8))
+    return Image.fromarray(floydSteinbergDitherVectorised(np.asarray(image).astype(np.float32), getClosest5bitEquivalentColor).astype(np.uint8))
 
 def scale8bpcTo5bpc(image : ImageType) -> ImageType:
     imageArray : np.ndarray = np.asarray(image).astype(np.float32)
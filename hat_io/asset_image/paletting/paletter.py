@@ -1,14 +1,94 @@
-from typing import List, Optional, Callable, Tuple
+from hashlib import blake2b
+from typing import List, Optional, Callable, Tuple, Union
 from PIL.Image import Image as ImageType
 from PIL import Image
 import numpy as np
 
+from sklearn import __version__ as sklearnVersion
 from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.utils import shuffle
 
+from .alpha_helper import getMaskFromPixelAllowed
+from .quantizer import getClosestColorDistances
 from .transforms import ColorManagementController, NullColorManagementController
+from ...cache import ByteCache
 from ....common import logSevere
 
+def _getFunctionIdentity(function : Callable) -> Optional[Tuple[str, str]]:
+    # Top-level functions are identified across runs by where they're defined. Lambdas, closures and partials can behave differently
+    #     under the same name and their addresses get reused, so they can't be identified at all
+    qualname = getattr(function, "__qualname__", None)
+    if qualname == None or "<" in qualname:
+        return None
+    return (getattr(function, "__module__", ""), qualname)
+
+class PaletteCache(ByteCache):
+    """Cache of palettes from generate5BitEncodedPalette, keyed by a hash of the sampled pixels and every setting that changes the output.
+    """
+
+    # Bump if palette generation changes so stale entries aren't reused
+    VERSION_ENTRY = 1
+
+    @staticmethod
+    def getKey(imageArray : np.ndarray, maskAllowed : Optional[np.ndarray], colorTransforms : ColorManagementController, maxColors : int,
+               fastKMeans : bool, kMeansSamples : int, seed : int, thresholdCloseColors : Optional[float]) -> Optional[str]:
+        """Gets the cache key for palette generation.
+
+        Args:
+            imageArray (np.ndarray): Image pixels as (height, width, 3) array.
+            maskAllowed (Optional[np.ndarray]): Boolean array matching image dimensions, True where pixels can contribute. None if all pixels can.
+            colorTransforms (ColorManagementController): Color transformation manager.
+            maxColors (int): Maximum length for the palette.
+            fastKMeans (bool): True if mini-batched k-means is used.
+            kMeansSamples (int): Number of samples used in clustering.
+            seed (int): Random seed.
+            thresholdCloseColors (Optional[float]): Compression distance for close colors.
+
+        Returns:
+            Optional[str]: Key for these settings. None if the color transforms can't be identified, so the palette shouldn't be cached.
+        """
+        identityToLinear = _getFunctionIdentity(colorTransforms.getToLinear())
+        identityFromLinear = _getFunctionIdentity(colorTransforms.fromLinear)
+        if identityToLinear == None or identityFromLinear == None:
+            return None
+
+        hasher = blake2b(digest_size=20)
+        settings = [PaletteCache.VERSION_ENTRY, sklearnVersion, type(colorTransforms).__module__, type(colorTransforms).__qualname__,
+                    identityToLinear, identityFromLinear, repr(colorTransforms.getGamma()),
+                    maxColors, fastKMeans, kMeansSamples, seed, repr(thresholdCloseColors), imageArray.shape]
+        hasher.update(repr(settings).encode("ascii"))
+        hasher.update(np.ascontiguousarray(imageArray, dtype=np.uint8).tobytes())
+        if maskAllowed is not None:
+            hasher.update(b'\x01')
+            hasher.update(np.packbits(maskAllowed.astype(bool)).tobytes())
+        return hasher.hexdigest()
+
+    def getPalette(self, key : str) -> Optional[List[Tuple[float,float,float]]]:
+        """Gets a cached palette.
+
+        Args:
+            key (str): Key from getKey.
+
+        Returns:
+            Optional[List[Tuple[float,float,float]]]: List of linear RGB tuples, or None if not cached.
+        """
+        data = self.get(key)
+        if data == None or len(data) == 0 or len(data) % 24 != 0:
+            return None
+        return [tuple(color) for color in np.frombuffer(data, dtype="<f8").astype(np.float64).reshape(-1, 3)]
+
+    def putPalette(self, key : str, palette : List[Tuple[float,float,float]]):
+        """Caches a palette.
+
+        Args:
+            key (str): Key from getKey.
+            palette (List[Tuple[float,float,float]]): List of linear RGB tuples.
+        """
+        self.put(key, np.array(palette, dtype="<f8").tobytes())
+
+# Shared cache for generate5BitEncodedPalette, eg PaletteCache("cache_palette") to skip k-means for images seen in earlier runs
+PALETTE_CACHE : Optional[PaletteCache] = None
+
 def encodedPaletteToRgb(palette : List[Tuple[float,float,float]], colorConvertBackward : Callable[[np.ndarray, float], np.ndarray], gamma : float) -> List[Tuple[int,int,int]]:
     output = []
     for idxPal, pal in enumerate(palette):
@@ -25,7 +105,9 @@ def generate5BitEncodedPalette(image : ImageType,
                                fastKMeans : bool = True,
                                kMeansSamples : int = 25000,
                                seed : int = 1,
-                               thresholdCloseColors : Optional[float] = 0.00025) -> List[Tuple[float,float,float]]:
+                               thresholdCloseColors : Optional[float] = 0.00025,
+                               maskPixelAllowedInPalette : Optional[np.ndarray] = None,
+                               cache : Optional[PaletteCache] = None) -> List[Tuple[float,float,float]]:
     """Function to generate a 5-bit compatible palette from the given image. K-means clustering is used for palette extraction. The output palette has been scaled by 255/31.
 
     An optional thresholding function is given to reduce the amount of colors output from the algorithm. This is enabled by default and collapses close colors into one by picking the first of the cluster.
@@ -42,6 +124,8 @@ def generate5BitEncodedPalette(image : ImageType,
         kMeansSamples (int, optional): Number of samples to be used in clustering. Smaller values are faster. Defaults to 25000.
         seed (int, optional): Random seed. Defaults to 1.
         thresholdCloseColors (Optional[float], optional): Compression distance to group close colors into one. If none, no compression is applied. Defaults to 0.0005, which safely reduces colors without much loss.
+        maskPixelAllowedInPalette (Optional[np.ndarray], optional): Boolean array matching image dimensions, True where pixels can contribute. Used instead of funcPixelAllowedInPalette if given. Defaults to None.
+        cache (Optional[PaletteCache], optional): Cache to reuse earlier output from. Defaults to None, which uses PALETTE_CACHE.
 
     Returns:
         List[Tuple[float,float,float]]: List of linear RGB tuples for use as palette.
@@ -50,19 +134,30 @@ def generate5BitEncodedPalette(image : ImageType,
 
     # Reshape and run k-means in RGB space to get initial palette
     # This is expensive!
-    imageReducedDepth : np.ndarray = colorTransforms.transToLinear((np.asarray(image) / 255))
-    
-    if funcPixelAllowedInPalette == None:
+    imageArray = np.asarray(image)
+    imageReducedDepth : np.ndarray = colorTransforms.transToLinear((imageArray / 255))
+
+    if maskPixelAllowedInPalette is not None:
+        maskSafeToSample = getMaskFromPixelAllowed(maskPixelAllowedInPalette, image.size)
+    else:
+        maskSafeToSample = getMaskFromPixelAllowed(funcPixelAllowedInPalette, image.size)
+
+    if cache == None:
+        cache = PALETTE_CACHE
+
+    keyCache = None
+    if cache != None:
+        keyCache = PaletteCache.getKey(imageArray, maskSafeToSample, colorTransforms, maxColors, fastKMeans, kMeansSamples, seed, thresholdCloseColors)
+    if keyCache != None:
+        cached = cache.getPalette(keyCache)
+        if cached != None:
+            return cached
+
+    if maskSafeToSample is None:
         kmeansInput = imageReducedDepth.reshape(-1, 3)
     else:
-        safeToSample = []
-        for y in range(imageReducedDepth.shape[0]):
-            for x in range(imageReducedDepth.shape[1]):
-                if funcPixelAllowedInPalette((x,y)):
-                    safeToSample.append(imageReducedDepth[y][x])
-        
-        assert len(safeToSample) > 0
-        kmeansInput = np.array(safeToSample)
+        kmeansInput = imageReducedDepth[maskSafeToSample]
+        assert kmeansInput.shape[0] > 0
     
     maxColors = min(maxColors, kmeansInput.shape[0])
     kmeansInput = shuffle(kmeansInput, random_state=seed, n_samples=min(kMeansSamples, kmeansInput.shape[0]))
@@ -75,68 +170,52 @@ def generate5BitEncodedPalette(image : ImageType,
         kmeans = KMeans(n_clusters=maxColors, random_state=seed).fit(kmeansInput)
     centroids = kmeans.cluster_centers_
 
-    # Remove duplicates
-    palette : List[Tuple[int,int,int]] = []
-    for val in centroids:
-        val = colorTransforms.transFromLinear(val)
-        # Range is 0 to 1, but apply 5bit RGB clamping now
-        val = (np.round(val * 31)) / 31
-        val = colorTransforms.transToLinear(val)
-        
-        val = (val[0], val[1], val[2])
-        if val not in palette:
-            palette.append(val)
+    # Range is 0 to 1, but apply 5bit RGB clamping now
+    centroids = colorTransforms.transFromLinear(centroids)
+    centroids = (np.round(centroids * 31)) / 31
+    centroids = colorTransforms.transToLinear(centroids)
+
+    # Remove duplicates, keeping the first of each
+    _unique, indicesFirst = np.unique(centroids, axis=0, return_index=True)
+    paletteNumpy = centroids[np.sort(indicesFirst)]
 
     # Note : Palette is linearised 5bpc palette colors
-    assert len(palette) > 0
-    
-    def getDistanceBetweenValues(val0 : Tuple[int,int,int], val1 : Tuple[int,int,int]) -> float:
-        total = 0
-        for item0, item1 in zip(val0, val1):
-            total += ((item0 - item1) ** 2)
-        return total
+    assert paletteNumpy.shape[0] > 0
 
     # We can apply color reduction by finding close colors and removing them
     if thresholdCloseColors != None:
         # Gamma correction - 0.01 is okay, but unideal. 0.005 is acceptable with some degradation. 0.001 provides good quality with minimal degradation.
         # This value is seemingly dependent on applied correction model...
         # TODO - Average
-        hasReduced = True
-        lenOld = len(palette)
-        while hasReduced:
-            hasReduced = False
-            for idxColor, color in enumerate(palette):
-                others = palette[:idxColor] + palette[idxColor + 1:]
-                toRemove = []
-                for altColor in others:
-                    if getDistanceBetweenValues(color, altColor) <= thresholdCloseColors:
-                        toRemove.append(altColor)
-                if len(toRemove) > 0:
-                    for item in toRemove:
-                        palette.remove(item)
-                    hasReduced = True
-                    break
-        logSevere("Compressed palette from", lenOld, "to", len(palette), name="Paletter")
+        lenOld = paletteNumpy.shape[0]
+        isClose = np.sum((paletteNumpy[:, None, :] - paletteNumpy[None, :, :]) ** 2, axis=2) <= thresholdCloseColors
 
+        # Greedily keep the earliest color of each group, removing every color close to it. A kept color can't be close to an
+        #     earlier kept color, so one pass in order is enough
+        isKept = np.ones(lenOld, dtype=bool)
+        for idxColor in range(lenOld):
+            if isKept[idxColor]:
+                isKept[idxColor + 1:] &= np.logical_not(isClose[idxColor, idxColor + 1:])
+        paletteNumpy = paletteNumpy[isKept]
+        logSevere("Compressed palette from", lenOld, "to", paletteNumpy.shape[0], name="Paletter")
+
+    palette = [tuple(color) for color in paletteNumpy]
+    if keyCache != None:
+        cache.putPalette(keyCache, palette)
     return palette
 
 def addToPalette(currentImages : List[ImageType], currentTransforms : List[ColorManagementController], currentPalette : List[Tuple[float,float,float]],
-                 currentFuncPixelAllowedInPalette : List[Optional[Callable[[Tuple[int,int]], bool]]], 
+                 currentFuncPixelAllowedInPalette : List[Optional[Union[Callable[[Tuple[int,int]], bool], np.ndarray]]], 
                  imagesToAdd : List[ImageType], imageTransforms : List[ColorManagementController],
-                 addFuncPixelAllowedInPalette : List[Optional[Callable[[Tuple[int,int]], bool]]],
+                 addFuncPixelAllowedInPalette : List[Optional[Union[Callable[[Tuple[int,int]], bool], np.ndarray]]],
                  errorThreshold : float = 0.005, maxColors : int = 199,
                  regenAllImageOnFail : bool = True) -> List[Tuple[float,float,float]]:
     
     assert len(currentImages) == len(currentTransforms) == len(currentFuncPixelAllowedInPalette)
     assert len(imagesToAdd) == len(imageTransforms) == len(addFuncPixelAllowedInPalette)
 
+    # TODO - Unify perceptual version of getClosestColorDistances
     paletteNumpy = np.array(currentPalette)
-    # TODO - Unify perceptual version of this
-    def getClosestColor(paletteNumpy : np.ndarray, val : np.ndarray) -> Tuple[float, np.ndarray]:
-        distances = np.sum((paletteNumpy-val)**2,axis=1)
-        idxSmallest = np.where(distances==np.amin(distances))
-        outIdx = np.amin(idxSmallest[0])
-        return (distances[outIdx], paletteNumpy[outIdx])
     
     # TODO - Conversion between color spaces to enable this properly
     logSevere("Color quality loss likely - multiple color mappings detected!", name="AddToPaletter")
@@ -147,21 +226,24 @@ def addToPalette(currentImages : List[ImageType], currentTransforms : List[Color
     for image, transform, isPermitted in zip(imagesToAdd, imageTransforms, addFuncPixelAllowedInPalette):
         assert image.mode == "RGB"
         imageReducedDepth : np.ndarray = transform.transToLinear((np.asarray(image) / 255))
-        for y in range(image.size[1]):
-            for x in range(image.size[0]):
-                if isPermitted == None or isPermitted((x,y)):
-                    color = imageReducedDepth[y,x]
-                    if len(currentPalette) == 0:
-                        erroneousPixelsSRgb.append(unifiedColorControl.transFromLinear(color))
-                    else:
-                        distance, _closest = getClosestColor(paletteNumpy, color)
-                        if distance >= errorThreshold:
-                            erroneousPixelsSRgb.append(unifiedColorControl.transFromLinear(color))
+        # Entries can be allow functions or boolean masks
+        maskPermitted = getMaskFromPixelAllowed(isPermitted, image.size)
+        if maskPermitted is None:
+            colors = imageReducedDepth.reshape(-1, 3)
+        else:
+            colors = imageReducedDepth[maskPermitted]
+        
+        if len(currentPalette) != 0 and colors.shape[0] > 0:
+            distances, _indices = getClosestColorDistances(paletteNumpy, colors)
+            colors = colors[distances >= errorThreshold]
+        if colors.shape[0] > 0:
+            erroneousPixelsSRgb.append(unifiedColorControl.transFromLinear(colors))
     
     if len(erroneousPixelsSRgb) == 0:
         return currentPalette
     else:
-        logSevere("Repaletting for", len(erroneousPixelsSRgb), "bad pixels...", name="AddToPaletter")
+        erroneousPixelsSRgb = np.concatenate(erroneousPixelsSRgb)
+        logSevere("Repaletting for", erroneousPixelsSRgb.shape[0], "bad pixels...", name="AddToPaletter")
     
     colorsRemaining = maxColors - len(currentPalette)
 
@@ -178,10 +260,7 @@ def addToPalette(currentImages : List[ImageType], currentTransforms : List[Color
             return currentPalette
     
     # If we do have some colors remaining, try quantizing
-    paletteImage = Image.new("RGB", (len(erroneousPixelsSRgb), 1))
-    for idxColor, color in enumerate(erroneousPixelsSRgb):
-        color = np.round(color * 255).astype(np.uint8)
-        paletteImage.putpixel((idxColor,0), (int(color[0]), int(color[1]), int(color[2])))
+    paletteImage = Image.frombytes("RGB", (erroneousPixelsSRgb.shape[0], 1), np.round(erroneousPixelsSRgb * 255).astype(np.uint8).tobytes())
     
     # Get our new palette and calculate error
     newPalette = generate5BitEncodedPalette(paletteImage, colorTransforms=unifiedColorControl, maxColors=colorsRemaining)
@@ -189,13 +268,12 @@ def addToPalette(currentImages : List[ImageType], currentTransforms : List[Color
 
     maxDistance = 0
     failed = False
-    for color in erroneousPixelsSRgb:
-        color = unifiedColorControl.transToLinear(color)
-        distance, _closest = getClosestColor(paletteNumpy, color)
-        if distance > errorThreshold:
-            maxDistance = max(maxDistance, distance)
-            failed = True
-            break
+    distances, _indices = getClosestColorDistances(paletteNumpy, unifiedColorControl.transToLinear(erroneousPixelsSRgb))
+    indicesFailed = np.flatnonzero(distances > errorThreshold)
+    if indicesFailed.size > 0:
+        # Report the first failure, as the search used to stop there
+        maxDistance = distances[indicesFailed[0]]
+        failed = True
     
     if failed:
         logSevere("Initial pass failed with distance", maxDistance, "generating", len(newPalette), "colors!", name="AddToPaletter")
@@ -208,6 +286,6 @@ def addToPalette(currentImages : List[ImageType], currentTransforms : List[Color
     # Return the new palette. If we did fail, don't waste the work
     return currentPalette + newPalette
 
-def createPaletteFromImages(images : List[ImageType], transforms : List[ColorManagementController], funcPixelAllowedInPalette : List[Optional[Callable[[Tuple[int,int]], bool]]],
+def createPaletteFromImages(images : List[ImageType], transforms : List[ColorManagementController], funcPixelAllowedInPalette : List[Optional[Union[Callable[[Tuple[int,int]], bool], np.ndarray]]],
                             maxColors : int = 199):
     return addToPalette([], [], [], [], images, transforms, funcPixelAllowedInPalette, maxColors=maxColors, regenAllImageOnFail=False)
\ No newline at end of file
@@ -1,16 +1,87 @@
+from functools import lru_cache
 from typing import Callable, List, Optional, Tuple
 from PIL.Image import Image as ImageType
 from PIL import Image
 
 import numpy as np
 
-from .dither import atkinsonDither
+from .alpha_helper import getMaskFromPixelAllowed
+from .dither import atkinsonDitherVectorised
 from .transforms import ColorManagementController, NullColorManagementController, linearToSRgb
 
+_SIZE_LOOKUP_CHUNK = 4096
+
+def _getDistances(vals : np.ndarray, paletteNp : np.ndarray, paletteSRgb : Optional[np.ndarray], gamma : float) -> np.ndarray:
+    # Distance from each row of vals to every palette color as (n, count) array
+    if paletteSRgb is None:
+        return np.sum((paletteNp - vals[:, None, :])**2, axis=2)
+    
+    vals = linearToSRgb(vals, gamma=gamma)[:, None, :]
+    deltasSq = np.square(paletteSRgb - vals)
+    perceptLow = np.sum(deltasSq * np.array([2,4,3]), axis=2)
+    perceptHigh = np.sum(deltasSq * np.array([3,4,2]), axis=2)
+    averageRed = (paletteSRgb + vals)[:, :, 0] / 2
+    return np.where(averageRed < 0.5, perceptLow, perceptHigh)
+
+def _getClosestIndices(vals : np.ndarray, paletteNp : np.ndarray, paletteSRgb : Optional[np.ndarray], gamma : float) -> np.ndarray:
+    # Index of closest palette color to each row of vals. argmin picks the first of any equally close colors
+    return np.argmin(_getDistances(vals, paletteNp, paletteSRgb, gamma), axis=1)
+
+def getClosestColorDistances(paletteNp : np.ndarray, colors : np.ndarray, paletteSRgb : Optional[np.ndarray] = None, gamma : float = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the closest palette color to many colors at once. Colors are searched in chunks to bound memory use.
+
+    Args:
+        paletteNp (np.ndarray): Palette as (count, channels) array.
+        colors (np.ndarray): Colors to search for as (n, channels) array.
+        paletteSRgb (Optional[np.ndarray], optional): Palette in sRGB space to use perceptual distance instead. Defaults to None, which uses squared Euclidean distance.
+        gamma (float, optional): Gamma for converting colors to sRGB when using perceptual distance. Defaults to 0.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Distance to and index of the closest palette color for each color. Ties go to the earliest palette color.
+    """
+    distances = np.zeros(colors.shape[0], dtype=np.float64)
+    indices = np.zeros(colors.shape[0], dtype=np.int64)
+    for indexChunk in range(0, colors.shape[0], _SIZE_LOOKUP_CHUNK):
+        distancesChunk = _getDistances(colors[indexChunk:indexChunk + _SIZE_LOOKUP_CHUNK], paletteNp, paletteSRgb, gamma)
+        indicesChunk = np.argmin(distancesChunk, axis=1)
+        indices[indexChunk:indexChunk + _SIZE_LOOKUP_CHUNK] = indicesChunk
+        distances[indexChunk:indexChunk + _SIZE_LOOKUP_CHUNK] = distancesChunk[np.arange(indicesChunk.shape[0]), indicesChunk]
+    return (distances, indices)
+
+@lru_cache(maxsize=8)
+def _getNearestLookupTable(palette : Tuple[Tuple[float,float,float], ...], colorTransforms : ColorManagementController, applyPerceptualBias : bool) -> np.ndarray:
+    # Closest palette index for every color in 5-bit space, indexed by r | g << 5 | b << 10
+    paletteNp = np.array(palette)
+    paletteSRgb = None
+    if applyPerceptualBias:
+        paletteSRgb = linearToSRgb(paletteNp, gamma=colorTransforms.getGamma())
+
+    levels = np.arange(32) / 31
+    b, g, r = np.meshgrid(levels, levels, levels, indexing="ij")
+    cells = colorTransforms.transToLinear(np.stack((r, g, b), axis=-1).reshape(-1, 3))
+
+    _distances, indices = getClosestColorDistances(paletteNp, cells, paletteSRgb, colorTransforms.getGamma())
+    return indices.astype(np.int32)
+
+def getIndicesFromPaletteColors(imageArray : np.ndarray, paletteNp : np.ndarray) -> np.ndarray:
+    """Maps each pixel to the index of its closest palette color by Euclidean distance. Each distinct color is only searched for once.
+
+    Args:
+        imageArray (np.ndarray): Image as (height, width, channels) array, e.g. dithered output.
+        paletteNp (np.ndarray): Palette as (count, channels) array in the same space as the image.
+
+    Returns:
+        np.ndarray: Index for each pixel as (height, width) array.
+    """
+    colors, inverse = np.unique(imageArray.reshape(-1, imageArray.shape[-1]), axis=0, return_inverse=True)
+    _distances, indicesColors = getClosestColorDistances(paletteNp, colors)
+    return indicesColors[inverse.reshape(-1)].reshape(imageArray.shape[:-1])
+
 def quantize(conversionImage : ImageType, paletteLinRgbEncoded : List[Tuple[int,int,int]],
              colorTransforms : ColorManagementController = NullColorManagementController(), applyPerceptualBias : bool = True,
              funcPixelAllowedError : Optional[Callable[[Tuple[int,int]], bool]] = None,
-             ditherFunction : Optional[Callable[[np.ndarray, Callable[[np.ndarray], np.ndarray], Callable[[Tuple[int,int]], bool]], np.ndarray]] = None) -> ImageType:
+             ditherFunction : Optional[Callable[[np.ndarray, Callable[[np.ndarray], np.ndarray], Callable[[Tuple[int,int]], bool]], np.ndarray]] = None,
+             maskPixelAllowedError : Optional[np.ndarray] = None, useLookupTable : bool = False) -> ImageType:
     """Error-diffusing quantizing function to quantize an image using the provided linear RGB palette.
 
     Args:
@@ -19,7 +90,9 @@ def quantize(conversionImage : ImageType, paletteLinRgbEncoded : List[Tuple[int,
         colorTransforms (ColorManagementController, optional): Color transformation controller. Defaults to NullColorManagementController().
         applyPerceptualBias (bool, optional): Adds perceptual biases into the color-comparison function. Can reduce excessive contrast. Defaults to True.
         funcPixelAllowedError (Optional[Callable[[Tuple[int,int]], bool]], optional): Function that returns True if pixel is allowed to be dithered. If not given, all pixels can contribute error. Defaults to None.
-        ditherFunction (Optional[Callable[[np.ndarray, Callable[[np.ndarray], np.ndarray], Callable[[Tuple[int,int]], bool]], np.ndarray]], optional): Dither function. If not provided, uses Atkinson's. Defaults to None.
+        ditherFunction (Optional[Callable[[np.ndarray, Callable[[np.ndarray], np.ndarray], Callable[[Tuple[int,int]], bool]], np.ndarray]], optional): Dither function. If not provided, uses Atkinson's, dithering many pixels at once. Defaults to None.
+        maskPixelAllowedError (Optional[np.ndarray], optional): Boolean array matching image dimensions, True where pixels are allowed to be dithered. Used instead of funcPixelAllowedError if given. Defaults to None.
+        useLookupTable (bool, optional): Find closest colors while dithering from a table over 5-bit color space, built once per palette. Faster for large palettes but colors are matched to the nearest 5-bit color first. Defaults to False.
 
     Returns:
         ImageType: PIL image in paletted mode.
@@ -28,10 +101,10 @@ def quantize(conversionImage : ImageType, paletteLinRgbEncoded : List[Tuple[int,
     assert len(paletteLinRgbEncoded) > 0
     assert conversionImage.mode == "RGB"
 
-    if ditherFunction == None:
-        ditherFunction = atkinsonDither
-
-    if funcPixelAllowedError == None:
+    if maskPixelAllowedError is not None:
+        def rejectAlphaMaskPixels(coord : Tuple) -> bool:
+            return not(maskPixelAllowedError[coord[1], coord[0]])
+    elif funcPixelAllowedError == None:
         def rejectAlphaMaskPixels(coord : Tuple) -> bool:
             return False
     else:
@@ -41,48 +114,38 @@ def quantize(conversionImage : ImageType, paletteLinRgbEncoded : List[Tuple[int,
     paletteNp = np.array(paletteLinRgbEncoded)
     conversionImage = colorTransforms.transToLinear((np.asarray(conversionImage) / 255))
 
+    paletteSRgb = None
     if applyPerceptualBias:
         # Apply a cheap sRGB-shifted perceptually-adjusted color distance function instead
         # Differences are very small
         # Credit: https://en.wikipedia.org/wiki/Color_difference
-
         paletteSRgb = linearToSRgb(paletteNp, gamma=colorTransforms.getGamma())
-        lowDiffCoeff = np.array([2,4,3])
-        highDiffCoeff = np.array([3,4,2])
-        
-        def getClosestColor(val : np.ndarray) -> np.ndarray:
-            val = linearToSRgb(val, gamma=colorTransforms.getGamma())
-            deltas = paletteSRgb - val
-            deltasSq = np.square(deltas)
-            perceptLow = np.sum(deltasSq * lowDiffCoeff, axis=1)
-            perceptHigh = np.sum(deltasSq * highDiffCoeff, axis=1)
-
-            averageRed = (paletteSRgb + val)[:, 0]
-            averageRed = averageRed / 2
-
-            distances = np.where(averageRed < 0.5, perceptLow, perceptHigh)
-            idxSmallest = np.where(distances==np.amin(distances))
-            return paletteNp[np.amin(idxSmallest[0])]
+
+    if useLookupTable:
+        lookupIndices = _getNearestLookupTable(tuple(tuple(color) for color in paletteNp.tolist()), colorTransforms, applyPerceptualBias)
+
+        def getClosestColors(vals : np.ndarray) -> np.ndarray:
+            cells = np.rint(np.clip(colorTransforms.transFromLinear(vals), 0, 1) * 31).astype(np.int32)
+            return paletteNp[lookupIndices[cells[:, 0] | (cells[:, 1] << 5) | (cells[:, 2] << 10)]]
     else:
-        def getClosestColor(val : np.ndarray) -> np.ndarray:
-            distances = np.sum((paletteNp-val)**2,axis=1)
-            idxSmallest = np.where(distances==np.amin(distances))
-            return paletteNp[np.amin(idxSmallest[0])]
-
-    output : np.ndarray = ditherFunction(conversionImage, getClosestColor, rejectAlphaMaskPixels)
-    newImage = Image.new("P", (output.shape[1], output.shape[0]))
-
-    # TODO - Do this in numpy. Not too slow but should be possible
-    #        There seems to be some precision loss that is making this harder though
-    def getClosestColorIdx(val : np.ndarray) -> int:
-        distances = np.sum((paletteNp-val)**2,axis=1)
-        idxSmallest = np.amin(np.where(distances==np.amin(distances))[0])
-        return idxSmallest
-
-    for y in range(output.shape[0]):
-        for x in range(output.shape[1]):
-            pixel = int(getClosestColorIdx(output[y,x]))
-            newImage.putpixel((x,y), pixel)
+        def getClosestColors(vals : np.ndarray) -> np.ndarray:
+            return paletteNp[_getClosestIndices(vals, paletteNp, paletteSRgb, colorTransforms.getGamma())]
+    
+    def getClosestColor(val : np.ndarray) -> np.ndarray:
+        return getClosestColors(val[None, :])[0]
+
+    if ditherFunction == None:
+        maskRejectPixel = None
+        if maskPixelAllowedError is not None:
+            maskRejectPixel = np.logical_not(maskPixelAllowedError)
+        elif funcPixelAllowedError != None:
+            maskRejectPixel = np.logical_not(getMaskFromPixelAllowed(funcPixelAllowedError, (conversionImage.shape[1], conversionImage.shape[0])))
+        output : np.ndarray = atkinsonDitherVectorised(conversionImage, getClosestColors, maskRejectPixel)
+    else:
+        output : np.ndarray = ditherFunction(conversionImage, getClosestColor, rejectAlphaMaskPixels)
+    
+    indices = getIndicesFromPaletteColors(output, paletteNp)
+    newImage = Image.frombytes("P", (output.shape[1], output.shape[0]), indices.astype(np.uint8).tobytes())
 
     pilPalette = []
     for color in paletteNp:
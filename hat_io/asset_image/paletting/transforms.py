@@ -41,6 +41,14 @@ class ColorManagementController():
         """
         return self.fromLinear(val, self.__gamma)
     
+    def getToLinear(self) -> Callable[[np.ndarray, float], np.ndarray]:
+        """Returns the function used to transform from native RGB to linear RGB space.
+
+        Returns:
+            Callable[[np.ndarray, float], np.ndarray]: Function taking colors and gamma.
+        """
+        return self.__toLinear
+
     def getGamma(self) -> float:
         """Returns the gamma for the transforms.
 
@@ -1,12 +1,14 @@
+from concurrent.futures import Executor
 from typing import Dict, List, Optional, Tuple
 
 from ...hat_io.asset_image.colour import eightToFive, fiveToEight
-from ..binary import BinaryReader, BinaryWriter
+from ..binary import BinaryReader
 from ...common import logVerbose
 from PIL.Image import Image as ImageType
 from PIL import Image
 from PIL.ImageFilter import GaussianBlur
 from math import ceil, log
+import numpy as np
 
 # TODO - Give method to TiledImage which iterates through every pixel of image,
 #        and eliminates any unused colours from the palette.
@@ -14,6 +16,8 @@ from math import ceil, log
 
 # TODO - Paletted non-Layton images will literally break everything
 
+_LOOKUP_EIGHT_TO_FIVE = np.array([eightToFive(value) for value in range(256)], dtype=np.uint8)
+
 def alignToFitTile(image : ImageType) -> ImageType:
     width, height = image.size
     if width % 8 == 0 and height % 8 == 0:
@@ -61,23 +65,98 @@ def getMaxPaletteValue(image : ImageType) -> Optional[int]:
 
 def getPaletteFromImages(images : List[ImageType]) -> ImageType:
     # There is a limit in PIL but hopefully this will never be reached
-    countPixels = 0
-    rgbImages : List[ImageType] = []
-    for image in images:
-        rgbImages.append(image.convert("RGB"))
-        width, height = image.size
-        countPixels += (width * height)
-    colourSlice = Image.new("RGB", (countPixels, 1))
-    colourSliceIndex = 0
-    for image in rgbImages:
-        width, height = image.size
-        for y in range(height):
-            for x in range(width):
-                colourSlice.putpixel((colourSliceIndex,0), image.getpixel((x,y)))
-                colourSliceIndex += 1
+    pixels = [np.asarray(image.convert("RGB")).reshape(-1, 3) for image in images]
+    if len(pixels) > 0:
+        pixels = np.concatenate(pixels)
+    else:
+        pixels = np.zeros((0, 3), dtype=np.uint8)
+    colourSlice = Image.frombytes("RGB", (pixels.shape[0], 1), pixels.tobytes())
     colourSlice = colourSlice.quantize(colors=TiledImageHandler.MAX_COUNT_COLOURS - 1)
     return colourSlice
 
+def getTilePixelsFromBytes(data : bytes, resolution : Tuple[int,int], bpp : int, countColours : int, useArjDecoding : bool = False) -> np.ndarray:
+    """Unpacks tile data into an array of palette indices. Pixels are packed least significant bits first.
+
+    Args:
+        data (bytes): Packed tile data. Missing data is treated as zero.
+        resolution (Tuple[int,int]): Tile dimensions.
+        bpp (int): Bits per pixel. Must divide 8.
+        countColours (int): Palette length; indices are wrapped to fit. 0 or 256+ leaves them unwrapped.
+        useArjDecoding (bool, optional): Data is stored in 8x8 sub-tiles rather than rows. Defaults to False.
+
+    Returns:
+        np.ndarray: Indices with shape (height, width).
+    """
+    width, height = resolution
+    pixelsPerByte = 8 // bpp
+    if useArjDecoding:
+        countSubTilesX = width // 8
+        countSubTilesY = height // 8
+        countPixels = countSubTilesX * countSubTilesY * 64
+    else:
+        countPixels = width * height
+    
+    lengthData = ceil(countPixels / pixelsPerByte)
+    packed = np.frombuffer(bytes(data[:lengthData]), dtype=np.uint8)
+    if packed.size < lengthData:
+        packed = np.concatenate((packed, np.zeros(lengthData - packed.size, dtype=np.uint8)))
+
+    if pixelsPerByte == 1:
+        pixels = packed.copy()
+    else:
+        shifts = np.arange(0, 8, bpp, dtype=np.uint8)
+        pixels = ((packed[:, None] >> shifts) & ((1 << bpp) - 1)).astype(np.uint8).reshape(-1)
+    pixels = pixels[:countPixels]
+    if 0 < countColours < 256:
+        pixels %= countColours
+
+    if useArjDecoding:
+        # Reorder 8x8 sub-tiles back into rows
+        pixels = pixels.reshape(countSubTilesY, countSubTilesX, 8, 8).transpose(0, 2, 1, 3).reshape(countSubTilesY * 8, countSubTilesX * 8)
+        if pixels.shape != (height, width):
+            output = np.zeros((height, width), dtype=np.uint8)
+            output[:pixels.shape[0], :pixels.shape[1]] = pixels
+            return output
+        return pixels
+    return pixels.reshape(height, width)
+
+def getBytesFromTilePixels(pixels : np.ndarray, bpp : int, isArj : bool = False) -> bytearray:
+    """Packs an array of palette indices into tile data. Pixels are packed least significant bits first.
+
+    Args:
+        pixels (np.ndarray): Indices with shape (height, width).
+        bpp (int): Bits per pixel. Must divide 8.
+        isArj (bool, optional): Store data in 8x8 sub-tiles rather than rows. Defaults to False.
+
+    Returns:
+        bytearray: Packed tile data.
+    """
+    pixelsPerByte = 8 // bpp
+    pixels = np.asarray(pixels, dtype=np.uint16)
+    height, width = pixels.shape
+    if isArj:
+        # Split into 8x8 sub-tiles and flatten each in turn
+        countSubTilesX = width // 8
+        countSubTilesY = height // 8
+        pixels = pixels[:countSubTilesY * 8, :countSubTilesX * 8].reshape(countSubTilesY, 8, countSubTilesX, 8).transpose(0, 2, 1, 3)
+        pixels = pixels.reshape(-1, 8)
+    else:
+        pixels = pixels[:, :(width // pixelsPerByte) * pixelsPerByte]
+    
+    pixels = pixels.reshape(-1, pixelsPerByte) << np.arange(0, 8, bpp, dtype=np.uint16)
+    if isArj:
+        packed = np.bitwise_or.reduce(pixels, axis=1)
+    else:
+        packed = pixels.sum(axis=1, dtype=np.uint16)
+    
+    if packed.size > 0 and packed.max() > 0xFF:
+        raise OverflowError("Pixel does not fit in " + str(bpp) + " bits")
+    return bytearray(packed.astype(np.uint8).tobytes())
+
+def _getTilePixelsFromBytesBatch(arguments : List[Tuple[bytes, Tuple[int,int], int, int, bool]]) -> List[np.ndarray]:
+    # Module-level so batches can be sent to worker processes
+    return [getTilePixelsFromBytes(*argument) for argument in arguments]
+
 class Tile():
 
     DEFAULT_RESOLUTION  = (8,8)
@@ -91,20 +170,9 @@ class Tile():
     
     def setImageFromBytes(self, data : bytes, resolution : Tuple[int,int], bpp : int, palette : List[int]):
         # TODO - Fix length of palette as this will always be 768 under PIL
-        self.image = Image.new("P", resolution)
+        pixels = getTilePixelsFromBytes(data, resolution, bpp, len(palette) // 3)
+        self.image = Image.frombytes("P", resolution, pixels.tobytes())
         self.image.putpalette(palette)
-        width, height = resolution
-        x = 0
-        y = 0
-        for indexPixel in range(width * height * bpp // 8):
-            packedPixel = data[indexPixel]
-            for _indexSubPixel in range(8 // bpp):
-                self.image.putpixel((x,y), (packedPixel & ((2 ** bpp) - 1)) % (len(palette) // 3))
-                packedPixel = packedPixel >> bpp
-                x += 1
-                if x == width:
-                    y += 1
-                    x = 0
 
     @staticmethod
     def fromBytes(data : bytes, resolution : Tuple[int,int], bpp : int, palette : List[int]):
@@ -113,37 +181,9 @@ class Tile():
         return output
     
     def toBytes(self, bpp : int, isArj : bool = False) -> bytearray:
-        # TODO : Buffer-style output? Overkill for only supporting 8bpp and 4bpp
-        output = BinaryWriter()
-        if self.image != None:
-            if isArj:
-                widthTile, heightTile = self.getDimensions()
-                pixelsPerBytes = 8 // bpp
-                # Should be 2 or 1...
-                for hSubTile in range(heightTile // 8):
-                    offsetH = hSubTile * 8
-                    for wSubTile in range(widthTile // 8):
-                        offsetW = wSubTile * 8
-                        for height in range(8):
-                            for widthChunk in range(8 // pixelsPerBytes):
-                                width = widthChunk * pixelsPerBytes
-                                encodedByte = 0
-                                for idxPixel in range(pixelsPerBytes):
-                                    pixel = self.image.getpixel((offsetW + width + idxPixel, offsetH + height))
-                                    encodedByte = encodedByte | (pixel << (bpp * idxPixel))
-                                output.writeInt(encodedByte, 1, signed=False)
-            else:
-                width, height = self.getDimensions()
-                pixelsPerByte = 8 // bpp
-                for y in range(height):
-                    for x in range(width // pixelsPerByte):
-                        workingByte = 0
-                        x *= pixelsPerByte
-                        for packIndex in range(pixelsPerByte):
-                            packPixel = self.image.getpixel((x + packIndex, y))
-                            workingByte += (packPixel << (packIndex * bpp))
-                        output.writeInt(workingByte, 1)
-        return output.data
+        if self.image == None:
+            return bytearray(b'')
+        return getBytesFromTilePixels(np.asarray(self.image), bpp, isArj=isArj)
     
     def setImage(self, image : Optional[ImageType]):
         self.image = image
@@ -184,39 +224,15 @@ class TileProlongedDecode(Tile):
     
     def decode(self, palette : List[int]):
         if self.needsDecode:
-            self.image.putpalette(palette)
-            width, height = self.image.size
-
-            if self.useArjDecoding:
-                pixelIndex = 0
-                for ht in range(height // 8):
-                    for wt in range(width // 8):
-                        for h in range(8):
-                            for w in range(8):
-                                if self.bpp == 4:
-                                    pixelByte = self.decodingData[pixelIndex // 2]
-                                    if pixelIndex % 2 == 1:
-                                        pixelByte = pixelByte >> self.bpp
-                                    pixelByte = pixelByte & ((2**self.bpp) - 1)
-                                else:
-                                    pixelByte = self.decodingData[pixelIndex]
-                                self.image.putpixel((w + wt * 8, h + ht * 8), pixelByte % (len(palette) // 3))
-                                pixelIndex += 1
+            self.setDecodedPixels(getTilePixelsFromBytes(*self.getDecodeArguments(palette)), palette)
 
-            else:
-                x = 0
-                y = 0
-                for indexPixel in range(width * height * self.bpp // 8):
-                    packedPixel = self.decodingData[indexPixel]
-                    for _indexSubPixel in range(8 // self.bpp):
-                        self.image.putpixel((x,y), (packedPixel & ((2 ** self.bpp) - 1)) % (len(palette) // 3))
-                        packedPixel = packedPixel >> self.bpp
-                        x += 1
-                        if x == width:
-                            y += 1
-                            x = 0
-
-            self.needsDecode = False
+    def getDecodeArguments(self, palette : List[int]) -> Tuple[bytes, Tuple[int,int], int, int, bool]:
+        return (self.decodingData, self.image.size, self.bpp, len(palette) // 3, self.useArjDecoding)
+
+    def setDecodedPixels(self, pixels : np.ndarray, palette : List[int]):
+        self.image.putpalette(palette)
+        self.image.frombytes(pixels.tobytes())
+        self.needsDecode = False
 
 class TiledImageHandler():
 
@@ -288,7 +304,6 @@ class TiledImageHandler():
         logVerbose("Palette set to", len(self.paletteRgbTriplets), name="Tiler")
 
     # TODO - Improve tile support for arj and rewrite to force typing (make more resilient)
-    # TODO - Multithread decoding for speedup especially on backgrounds
     def addTileFromReader(self, reader : BinaryReader, prolongDecoding : bool = False, useArjDecoding : bool = False,
                           resolution : Tuple[int,int] = Tile.DEFAULT_RESOLUTION, glb : Tuple[int,int] = Tile.DEFAULT_GLB,
                           offset : Tuple[int,int] = Tile.DEFAULT_OFFSET, overrideBpp : int = -1):
@@ -305,13 +320,89 @@ class TiledImageHandler():
         tempTile.setOffset(offset)
         self.tiles.append(tempTile)
     
-    def decodeProlongedTiles(self):
-        for tile in self.getTiles():
-            if type(tile) == TileProlongedDecode:
+    def decodeProlongedTiles(self, executor : Optional[Executor] = None, countTilesPerTask : int = 16):
+        """Decodes any tiles that were added with prolonged decoding.
+
+        Args:
+            executor (Optional[Executor], optional): Executor to split decoding across, e.g. a ThreadPoolExecutor or ProcessPoolExecutor
+                shared between images. Results are applied in tile order. Defaults to None, which decodes in this thread.
+            countTilesPerTask (int, optional): Tiles decoded per submitted task when using an executor. Defaults to 16.
+        """
+        tilesPending = [tile for tile in self.getTiles() if type(tile) == TileProlongedDecode and tile.needsDecode]
+        if executor == None:
+            for tile in tilesPending:
                 tile.decode(self.paletteContinuous)
+            return
+        
+        countTilesPerTask = max(countTilesPerTask, 1)
+        futures = []
+        for indexTile in range(0, len(tilesPending), countTilesPerTask):
+            arguments = [tile.getDecodeArguments(self.paletteContinuous) for tile in tilesPending[indexTile:indexTile + countTilesPerTask]]
+            futures.append(executor.submit(_getTilePixelsFromBytesBatch, arguments))
+        
+        indexTile = 0
+        for future in futures:
+            for pixels in future.result():
+                tilesPending[indexTile].setDecodedPixels(pixels, self.paletteContinuous)
+                indexTile += 1
+ 
+    def tilesToImage(self, resolution : Tuple[int,int], useOffset : bool = False, executor : Optional[Executor] = None) -> ImageType:
+        self.decodeProlongedTiles(executor=executor)
+        width, height = resolution
+        
+        # Composite indices directly when every tile is paletted, otherwise let PIL convert while pasting
+        tileImages = [tile.getImage() for tile in self.tiles]
+        if all(tileImage != None and tileImage.mode == "P" for tileImage in tileImages):
+            pixels = np.zeros((height, width), dtype=np.uint8)
+            if useOffset:
+                for tile, tileImage in zip(self.tiles, tileImages):
+                    x, y = tile.offset
+                    tilePixels = np.asarray(tileImage)
+                    # Clip to output, as paste would
+                    left = max(x, 0)
+                    upper = max(y, 0)
+                    right = min(x + tilePixels.shape[1], width)
+                    lower = min(y + tilePixels.shape[0], height)
+                    if left < right and upper < lower:
+                        pixels[upper:lower, left:right] = tilePixels[upper - y:lower - y, left - x:right - x]
+            elif len(tileImages) > 0 and all(tileImage.size == Tile.DEFAULT_RESOLUTION for tileImage in tileImages):
+                self.__compositeTileMap(pixels, np.stack([np.asarray(tileImage) for tileImage in tileImages]))
+            else:
+                return self.__tilesToImagePasted(resolution, useOffset)
+            
+            output = Image.frombytes("P", resolution, pixels.tobytes())
+            output.putpalette(self.paletteContinuous)
+            return output
+        return self.__tilesToImagePasted(resolution, useOffset)
+
+    def __compositeTileMap(self, pixels : np.ndarray, tilePixels : np.ndarray):
+        height, width = pixels.shape
+        if len(self.tileMap) == 0:
+            return
+        
+        resolutionXTiles = ceil(width / 8)
+        resolutionYTiles = ceil(height / 8)
+        tileMapIndices = np.fromiter(self.tileMap.keys(), dtype=np.int64, count=len(self.tileMap))
+        tileMapValues = np.fromiter(self.tileMap.values(), dtype=np.int64, count=len(self.tileMap))
+        
+        tileSelectedIndex = tileMapValues & (2 ** 10 - 1)
+        y = tileMapIndices // resolutionXTiles
+        x = tileMapIndices % resolutionXTiles
+        isVisible = (tileSelectedIndex < (2 ** 10 - 1)) & (y >= 0) & (y < resolutionYTiles)
+        tileMapValues = tileMapValues[isVisible]
+        tileSelectedIndex = tileSelectedIndex[isVisible] % tilePixels.shape[0]
+
+        # Precompute every flip of each tile, indexed by (tile, flipY << 1 | flipX)
+        flippedX = tilePixels[:, :, ::-1]
+        tileVariants = np.stack((tilePixels, flippedX, tilePixels[:, ::-1, :], flippedX[:, ::-1, :]), axis=1)
+        tileFlip = ((tileMapValues >> 11) & 1) | (((tileMapValues >> 10) & 1) << 1)
+
+        # Lay out output as a grid of 8x8 tiles so tiles can be scattered into place
+        grid = np.zeros((resolutionYTiles, resolutionXTiles, 8, 8), dtype=np.uint8)
+        grid[y[isVisible], x[isVisible]] = tileVariants[tileSelectedIndex, tileFlip]
+        pixels[:, :] = grid.transpose(0, 2, 1, 3).reshape(resolutionYTiles * 8, resolutionXTiles * 8)[:height, :width]
  
-    def tilesToImage(self, resolution : Tuple[int,int], useOffset : bool = False) -> ImageType:
-        self.decodeProlongedTiles()
+    def __tilesToImagePasted(self, resolution : Tuple[int,int], useOffset : bool = False) -> ImageType:
         width, height = resolution
         output = Image.new("P", resolution)
         output.putpalette(self.paletteContinuous)
@@ -342,7 +433,7 @@ class TiledImageHandler():
                     output.paste(tileImage, (x * 8, y * 8))
         return output
     
-    def imageToTiles(self, image : ImageType, useOffset : bool = False, usePalette : List[int] = [], maxDim : int = 128) -> Optional[Tuple[int,int]]:
+    def imageToTiles(self, image : ImageType, useOffset : bool = False, usePalette : List[int] = [], maxDim : int = 128, detectFlips : bool = True) -> Optional[Tuple[int,int]]:
 
         def getDimensionSplits(dimension : int, maxDim : int) -> List[int]:
             dimension = round(ceil(dimension / 8) * 8)
@@ -373,22 +464,15 @@ class TiledImageHandler():
         if width > (2 ** 16 - 1) or height > (2 ** 16 - 1):
             return None
         
-        alphaFillPixels = []
+        alphaFillMask : Optional[np.ndarray] = None
         if imagePadded.mode == "RGBA":
             logVerbose("Fixing alpha...", name="TilerToTile")
             # Get alpha pixels
             blurredImage = imagePadded.convert("RGB").filter(GaussianBlur(radius=4))
-            compositedImage = Image.new("RGB", imagePadded.size)
-            for y in range(height):
-                for x in range(width):
-                    r,g,b,a = imagePadded.getpixel((x,y))
-                    if a >= 0.5:
-                        compositedImage.putpixel((x,y), (r,g,b))
-                    else:
-                        compositedImage.putpixel((x,y), blurredImage.getpixel((x,y)))
-                        alphaFillPixels.append((x,y))
-
-            imagePadded = compositedImage
+            pixels = np.asarray(imagePadded)
+            alphaFillMask = pixels[:, :, 3] < 0.5
+            compositedPixels = np.where(alphaFillMask[:, :, None], np.asarray(blurredImage), pixels[:, :, :3])
+            imagePadded = Image.frombytes("RGB", imagePadded.size, compositedPixels.astype(np.uint8).tobytes())
             
         if imagePadded.mode != "P":
             logVerbose("\tQuantizing...", name="TilerToTile")
@@ -399,14 +483,10 @@ class TiledImageHandler():
                 # assume palette is already 5 bit (bad)
                 imagePadded = imagePadded.quantize(palette=usePalette, dither=Image.FLOYDSTEINBERG)
             else:
-                imagePaddedPalette = imagePadded.copy()
-
                 # Quantize in 5 bit space
                 width, height = imagePadded.size
-                for x in range(width):
-                    for y in range(height):
-                        r,g,b = imagePaddedPalette.getpixel((x,y))
-                        imagePaddedPalette.putpixel((x,y), (eightToFive(r), eightToFive(g), eightToFive(b)))
+                pixelsFiveBit = _LOOKUP_EIGHT_TO_FIVE[np.asarray(imagePadded.convert("RGB"))]
+                imagePaddedPalette = Image.frombytes("RGB", imagePadded.size, pixelsFiveBit.tobytes())
                 imagePaddedPalette = imagePaddedPalette.quantize(colors=(TiledImageHandler.MAX_COUNT_COLOURS - 1))
 
                 # Scale palette back to 8 bit space so dither can be more perceptually accurate
@@ -433,8 +513,8 @@ class TiledImageHandler():
             # TODO - Cull used palette (can be too long)
             imagePadded = imagePadded.point(lambda c: c + 1)
             imagePadded.putpalette(alphaPalette)
-            for alphaPos in alphaFillPixels:
-                imagePadded.putpixel(alphaPos, 0)
+            if alphaFillMask is not None:
+                imagePadded.paste(0, mask=Image.frombytes("L", imagePadded.size, (alphaFillMask.astype(np.uint8) * 255).tobytes()))
         
         self.extractPaletteFromImage(imagePadded)
         
@@ -457,16 +537,30 @@ class TiledImageHandler():
             logVerbose("\tFilling tilemap layout...", name="TilerToTile")
             tileIndex = 0
             # TODO : Verify length of tiles to not exceed selectable amount (not possible?)
-            # TODO : Improve detection to find mirrored tiles too
+            pixels = np.asarray(imagePadded)
+            tileLookup : Dict[bytes, int] = {}
             for tileY in range(height // 8):
                 for tileX in range(width // 8):
                     left = tileX * 8
                     upper = tileY * 8
-                    tempTile = Tile()
-                    tempTile.setImage(imagePadded.crop(box=(left, upper, left + 8, upper + 8)))
-                    try:
-                        self.tileMap[tileIndex] = self.tiles.index(tempTile)
-                    except ValueError:
+                    tilePixels = pixels[upper:upper + 8, left:left + 8]
+
+                    # Try an exact match, then mirrored matches using the same flip bits as tilesToImage
+                    candidates = [(tilePixels, 0)]
+                    if detectFlips:
+                        candidates.extend(((tilePixels[:, ::-1], 2 ** 11),
+                                           (tilePixels[::-1, :], 2 ** 10),
+                                           (tilePixels[::-1, ::-1], 2 ** 11 | 2 ** 10)))
+
+                    for candidatePixels, flags in candidates:
+                        indexMatch = tileLookup.get(candidatePixels.tobytes())
+                        if indexMatch != None:
+                            self.tileMap[tileIndex] = indexMatch | flags
+                            break
+                    else:
+                        tempTile = Tile()
+                        tempTile.setImage(imagePadded.crop(box=(left, upper, left + 8, upper + 8)))
+                        tileLookup[tilePixels.tobytes()] = len(self.tiles)
                         self.tileMap[tileIndex] = len(self.tiles)
                         self.tiles.append(tempTile)
 
@@ -0,0 +1,199 @@
+from __future__ import annotations
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, wait
+from os import cpu_count, makedirs, walk
+from os.path import dirname, join, relpath
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+from .asset import File
+from ..common import logSevere
+
+MODE_DECOMPRESS = "decompress"
+MODE_COMPRESS   = "compress"
+
+class BatchSummary():
+    def __init__(self):
+        self.countFiles         : int   = 0
+        self.countChanged       : int   = 0
+        self.countFailed        : int   = 0
+        self.lengthIn           : int   = 0
+        self.lengthOut          : int   = 0
+        self.duration           : float = 0
+
+    def getThroughput(self) -> float:
+        """Gets input throughput of the batch so far.
+
+        Returns:
+            float: Input bytes processed per second.
+        """
+        if self.duration <= 0:
+            return 0
+        return self.lengthIn / self.duration
+
+    def __str__(self):
+        return "%d files (%d changed, %d failed), %d -> %d bytes in %.2fs (%.2f MB/s)" % (self.countFiles, self.countChanged, self.countFailed,
+                                                                                           self.lengthIn, self.lengthOut, self.duration,
+                                                                                           self.getThroughput() / 1000000)
+
+def _processFile(pathIn : str, pathOut : str, mode : str, addHeader : bool, copyUnchanged : bool) -> Tuple[bool, bool, int, int]:
+    # Module-level so it can be sent to worker processes. Returns (success, changed, lengthIn, lengthOut)
+    try:
+        with open(pathIn, 'rb') as dataIn:
+            file = File(data=dataIn.read())
+    except IOError:
+        return (False, False, 0, 0)
+
+    lengthIn = len(file.data)
+    decompressMethod, _offsetIn = file.getDecompressionMethod()
+    success = True
+    if mode == MODE_DECOMPRESS:
+        changed = file.decompress()
+        # Looked compressed but couldn't be decoded, so report it rather than passing it off as raw data
+        success = changed or decompressMethod == None
+    else:
+        # Don't compress files twice. Headers are only a guess so only skip files that really do decode
+        changed = lengthIn > 0 and (decompressMethod == None or not(File(data=file.data).decompress()))
+        if changed:
+            file.compress(addHeader=addHeader)
+
+    if not(changed) and not(copyUnchanged):
+        return (success, False, lengthIn, 0)
+
+    try:
+        if dirname(pathOut) != "":
+            makedirs(dirname(pathOut), exist_ok=True)
+        with open(pathOut, 'wb') as dataOut:
+            dataOut.write(file.data)
+    except IOError:
+        return (False, changed, lengthIn, 0)
+    return (success, changed, lengthIn, len(file.data))
+
+def getBatchPaths(pathIn : str, pathOut : str) -> List[Tuple[str, str]]:
+    """Walks a directory tree, such as an extracted ROM filesystem, pairing each file with its mirrored location under an output directory.
+
+    Args:
+        pathIn (str): Root of input tree.
+        pathOut (str): Root of output tree. Can be the same as the input to work in place.
+
+    Returns:
+        List[Tuple[str, str]]: Input and output path for each file, in a stable order.
+    """
+    output = []
+    for root, dirs, files in walk(pathIn):
+        dirs.sort()
+        for name in sorted(files):
+            filepath = join(root, name)
+            output.append((filepath, join(pathOut, relpath(filepath, pathIn))))
+    return output
+
+def processBatch(paths : List[Tuple[str, str]], mode : str = MODE_DECOMPRESS, addHeader : bool = False, copyUnchanged : bool = True,
+                 countWorkers : Optional[int] = None, executor : Optional[Executor] = None, maxPending : Optional[int] = None,
+                 functionProgress : Optional[Callable[[BatchSummary], None]] = None) -> BatchSummary:
+    """Decompresses or compresses many files in parallel, writing the results to new paths.
+
+    Decompression detects the method with File.decompress, so files that aren't compressed are left as-is and files that look compressed
+    but fail to decode are counted as failed. Compression keeps the shortest output from File.compress and leaves files that are already
+    compressed as-is.
+
+    Args:
+        paths (List[Tuple[str, str]]): Input and output path for each file, e.g. from getBatchPaths.
+        mode (str, optional): MODE_DECOMPRESS or MODE_COMPRESS. Defaults to MODE_DECOMPRESS.
+        addHeader (bool, optional): Add the LAYTON1 compression header when compressing. Defaults to False.
+        copyUnchanged (bool, optional): Write files that weren't changed to their output path too. Defaults to True.
+        countWorkers (Optional[int], optional): Worker processes to start if no executor is given. 1 processes files in this process. Defaults to None, which uses every core.
+        executor (Optional[Executor], optional): Existing executor to submit work to. Defaults to None.
+        maxPending (Optional[int], optional): Limit on files submitted but not finished, bounding memory use. Defaults to None, which uses 4 per worker.
+        functionProgress (Optional[Callable[[BatchSummary], None]], optional): Called with the running totals after each file completes. Defaults to None.
+
+    Returns:
+        BatchSummary: Totals for the batch.
+    """
+    if mode not in [MODE_DECOMPRESS, MODE_COMPRESS]:
+        raise ValueError("Unsupported batch mode " + str(mode))
+
+    summary = BatchSummary()
+    timeStart = perf_counter()
+
+    def addResult(result : Tuple[bool, bool, int, int]):
+        success, changed, lengthIn, lengthOut = result
+        summary.countFiles += 1
+        if not(success):
+            summary.countFailed += 1
+        if changed:
+            summary.countChanged += 1
+        summary.lengthIn += lengthIn
+        summary.lengthOut += lengthOut
+        summary.duration = perf_counter() - timeStart
+        if callable(functionProgress):
+            functionProgress(summary)
+
+    if countWorkers == None:
+        countWorkers = cpu_count() or 1
+
+    if executor == None and countWorkers <= 1:
+        for pathIn, pathOut in paths:
+            addResult(_processFile(pathIn, pathOut, mode, addHeader, copyUnchanged))
+        return summary
+
+    ownsExecutor = executor == None
+    if ownsExecutor:
+        executor = ProcessPoolExecutor(max_workers=countWorkers)
+    if maxPending == None:
+        maxPending = countWorkers * 4
+    maxPending = max(maxPending, 1)
+
+    pending : Dict[Future, str] = {}
+
+    def collect():
+        done, _notDone = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pathIn = pending.pop(future)
+            try:
+                addResult(future.result())
+            except Exception as e:
+                logSevere("Failed to process", pathIn, ":", e, name="Batch")
+                addResult((False, False, 0, 0))
+
+    try:
+        for pathIn, pathOut in paths:
+            while len(pending) >= maxPending:
+                collect()
+            pending[executor.submit(_processFile, pathIn, pathOut, mode, addHeader, copyUnchanged)] = pathIn
+        while len(pending) > 0:
+            collect()
+    finally:
+        if ownsExecutor:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    return summary
+
+def main(args : Optional[List[str]] = None) -> int:
+    parser = ArgumentParser(description="Decompress or compress every file in a directory tree, e.g. an extracted ROM filesystem.")
+    parser.add_argument("mode", choices=[MODE_DECOMPRESS, MODE_COMPRESS])
+    parser.add_argument("input", help="Input directory")
+    parser.add_argument("output", help="Output directory. Can match input to work in place")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes (default: every core)")
+    parser.add_argument("--header", action="store_true", help="Add LAYTON1 compression header when compressing")
+    parser.add_argument("--skip-unchanged", action="store_true", help="Don't write files that weren't changed")
+    parser.add_argument("--progress", type=int, default=100, help="Report progress every N files, 0 to disable")
+    parsed = parser.parse_args(args)
+
+    paths = getBatchPaths(parsed.input, parsed.output)
+    countPaths = len(paths)
+
+    def reportProgress(summary : BatchSummary):
+        if parsed.progress > 0 and (summary.countFiles % parsed.progress == 0 or summary.countFiles == countPaths):
+            print("%d/%d files, %.2f MB/s" % (summary.countFiles, countPaths, summary.getThroughput() / 1000000))
+
+    summary = processBatch(paths, mode=parsed.mode, addHeader=parsed.header, copyUnchanged=not(parsed.skip_unchanged),
+                           countWorkers=parsed.jobs, functionProgress=reportProgress)
+    print(summary)
+    if summary.countFailed > 0:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
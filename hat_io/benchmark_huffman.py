@@ -0,0 +1,128 @@
+import sys
+from argparse import ArgumentParser
+from random import Random
+from time import perf_counter
+from typing import Callable, List, Optional, Tuple
+from .asset import File
+
+# Malformed streams that previously broke the lookup decoder. Both decoders must give the same result on each
+MALFORMED_STREAMS = [bytes.fromhex("287017000400c0810002"),                 # Truncated tree, stream never takes the missing branch
+                     bytes.fromhex("247017000f00408101000181")]             # Truncated tree, stream takes the missing branch
+
+def getSamplePayload(length : int, useHalfByteBlocks : bool, seed : int = 0) -> bytes:
+    """Generates skewed data that compresses roughly like game assets, so code lengths vary like real Huffman trees.
+
+    Args:
+        length (int): Length of payload in bytes.
+        useHalfByteBlocks (bool): True to keep the payload within 16 values, mirroring 4-bit images.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        bytes: Uncompressed payload.
+    """
+    rng = Random(seed)
+    if useHalfByteBlocks:
+        symbols = list(range(16))
+    else:
+        symbols = list(range(256))
+    weights = [1 / (index + 1) for index in range(len(symbols))]
+    return bytes(rng.choices(symbols, weights=weights, k=length))
+
+def timeDecoder(compressed : bytes, useLookupTable : bool, repeats : int) -> Tuple[float, bytes]:
+    """Times the best of several decodes of one compressed stream.
+
+    Args:
+        compressed (bytes): Huffman-compressed data without LAYTON1 header.
+        useLookupTable (bool): True to use the table decoder, False to walk the tree.
+        repeats (int): Decodes to run.
+
+    Returns:
+        Tuple[float, bytes]: Fastest decode in seconds and the decoded data.
+    """
+    best = None
+    output = b''
+    for _indexRepeat in range(repeats):
+        file = File(data = compressed)
+        start = perf_counter()
+        file.decompressHuffman(useLookupTable = useLookupTable)
+        duration = perf_counter() - start
+        if best == None or duration < best:
+            best = duration
+        output = bytes(file.data)
+    return (best, output)
+
+def runBenchmark(length : int = 1 << 20, repeats : int = 3, functionReport : Callable[[str], None] = print) -> bool:
+    """Compares the throughput of both Huffman decoders over 4-bit and 8-bit payloads.
+
+    Args:
+        length (int, optional): Uncompressed payload length in bytes. Defaults to 1MB.
+        repeats (int, optional): Decodes per decoder, fastest is kept. Defaults to 3.
+        functionReport (Callable[[str], None], optional): Receives one line of results per payload. Defaults to print.
+
+    Returns:
+        bool: True if both decoders restored every payload.
+    """
+    success = True
+    for useHalfByteBlocks in (True, False):
+        payload = getSamplePayload(length, useHalfByteBlocks)
+        file = File(data = payload)
+        file.compressHuffman(useHalfByteBlocks = useHalfByteBlocks)
+        compressed = bytes(file.data)
+
+        durationLookup, outputLookup = timeDecoder(compressed, True, repeats)
+        durationTree, outputTree = timeDecoder(compressed, False, repeats)
+        if outputLookup != payload or outputTree != payload:
+            success = False
+
+        if useHalfByteBlocks:
+            nameMode = "4-bit"
+        else:
+            nameMode = "8-bit"
+        functionReport("%s: %d -> %d bytes, lookup %.2f MB/s, tree %.2f MB/s (%.1fx)" % (nameMode, len(payload), len(compressed),
+                                                                                        len(payload) / durationLookup / 1000000,
+                                                                                        len(payload) / durationTree / 1000000,
+                                                                                        durationTree / durationLookup))
+    return success
+
+def _getDecoderResult(data : bytes, useLookupTable : bool) -> Tuple[str, bytes]:
+    file = File(data = data)
+    try:
+        result = file.decompressHuffman(useLookupTable = useLookupTable)
+    except Exception as exc:
+        return (type(exc).__name__, b'')
+    return (str(result), bytes(file.data))
+
+def checkMalformedStreams(functionReport : Callable[[str], None] = print) -> bool:
+    """Checks both Huffman decoders agree on every stream in MALFORMED_STREAMS, including failing the same way.
+
+    Args:
+        functionReport (Callable[[str], None], optional): Receives one line for each disagreeing stream. Defaults to print.
+
+    Returns:
+        bool: True if the decoders agreed on every stream.
+    """
+    success = True
+    for data in MALFORMED_STREAMS:
+        resultLookup = _getDecoderResult(data, True)
+        resultTree = _getDecoderResult(data, False)
+        if resultLookup != resultTree:
+            functionReport("%s: lookup gave %s, tree gave %s" % (data.hex(), resultLookup[0], resultTree[0]))
+            success = False
+    return success
+
+def main(args : Optional[List[str]] = None) -> int:
+    parser = ArgumentParser(description="Compare throughput of the lookup table and tree-walking Huffman decoders.")
+    parser.add_argument("--length", type=int, default=1 << 20, help="Uncompressed payload length in bytes (default: 1MB)")
+    parser.add_argument("--repeats", type=int, default=3, help="Decodes per decoder, fastest is reported")
+    parsed = parser.parse_args(args)
+
+    if not(checkMalformedStreams()):
+        print("Decoders disagreed on malformed streams!")
+        return 1
+    if runBenchmark(length=parsed.length, repeats=parsed.repeats):
+        return 0
+    print("Decoder output did not match the original payload!")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
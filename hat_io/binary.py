@@ -1,27 +1,67 @@
 # All little-endian
 
-from struct import unpack, pack
+from array import array
+from mmap import mmap, ACCESS_READ
+from struct import Struct, unpack, pack, error as StructError
 from ..common import logSevere
 
+_STRUCT_FLOAT = Struct("<f")
+_STRUCT_INT = {(1, False):Struct("<B"), (1, True):Struct("<b"),
+               (2, False):Struct("<H"), (2, True):Struct("<h"),
+               (4, False):Struct("<I"), (4, True):Struct("<i"),
+               (8, False):Struct("<Q"), (8, True):Struct("<q")}
+_IS_HOST_BIG_ENDIAN = array("H", b'\x00\x01')[0] == 1
+
 class BinaryReader():
 
     # TODO - Validate writing data (min)
 
-    def __init__(self, filename='', data=b''):
+    def __init__(self, filename='', data=b'', zeroCopy=False):
+        """Little-endian reader over a file or buffer.
+
+        By default, the input is copied so the reader owns its data. With zeroCopy, the reader instead wraps a memoryview over the caller's
+        buffer (or a read-only memory map of the file) and only copies data out when read is called. Use readView to borrow data without copying.
+
+        Args:
+            filename (str, optional): Path to read from. Takes priority over data. Defaults to ''.
+            data (bytes, optional): Buffer to read from. Defaults to b''.
+            zeroCopy (bool, optional): Wrap input without copying it. The caller's buffer must not be resized while the reader is in use. Defaults to False.
+        """
+        self._map = None
         if filename != '':
             try:
                 with open(filename, 'rb') as dataIn:
-                    self.data = bytearray(dataIn.read())
+                    if zeroCopy:
+                        try:
+                            self._map = mmap(dataIn.fileno(), 0, access=ACCESS_READ)
+                            data = self._map
+                        except ValueError:
+                            # Empty files can't be mapped
+                            data = b''
+                    else:
+                        data = dataIn.read()
             except FileNotFoundError:
                 logSevere("Path", filename, "doesn't exist!", name="BinImport")
-                self.data = bytearray(data)
             except IOError:
-                self.data = bytearray(data)
+                pass
+
+        if zeroCopy:
+            self.data = memoryview(data).cast("B")
         else:
             self.data = bytearray(data)
 
         self.pos = 0
 
+    def close(self):
+        """Releases any view or memory map held by this reader. Only needed for zero-copy readers.
+        """
+        if type(self.data) == memoryview:
+            self.data.release()
+            self.data = bytearray(b'')
+        if self._map != None:
+            self._map.close()
+            self._map = None
+
     def seek(self, newPos, mode=0):
         if mode == 0:
             self.pos = newPos
@@ -40,34 +80,87 @@ class BinaryReader():
 
     def read(self, length):
         self.pos += length
+        if type(self.data) == memoryview:
+            return bytearray(self.data[self.pos - length:self.pos])
         return self.data[self.pos - length:self.pos]
 
+    def readView(self, length) -> memoryview:
+        """Reads without copying. The output is a view into the reader's data so should be converted if it needs to be kept.
+
+        Args:
+            length (int): Length in bytes.
+
+        Returns:
+            memoryview: View over the read data.
+        """
+        self.pos += length
+        return memoryview(self.data)[self.pos - length:self.pos]
+
     def readFloat(self, length):
+        if length == 4 and 0 <= self.pos <= len(self.data) - 4:
+            self.pos += 4
+            return _STRUCT_FLOAT.unpack_from(self.data, self.pos - 4)[0]
         return unpack("<f", self.read(length))[0]
 
     def readF32(self):
         return self.readFloat(4)
     
     def readInt(self, length, signed=True):
+        structInt = _STRUCT_INT.get((length, signed))
+        if structInt != None and self.pos >= 0:
+            try:
+                output = structInt.unpack_from(self.data, self.pos)[0]
+                self.pos += length
+                return output
+            except StructError:
+                # Not enough data remaining, so use the short read below
+                pass
         return int.from_bytes(self.read(length), byteorder = 'little', signed=signed)
     
     def readUInt(self, length):
         return self.readInt(length, signed=False)
 
     def readU16(self):
-        return self.readUInt(2)
+        return self.readInt(2, signed=False)
 
     def readU32(self):
-        return self.readUInt(4)
+        return self.readInt(4, signed=False)
     
+    def readArray(self, typecode, count) -> array:
+        """Reads consecutive little-endian integers in one pass.
+
+        Args:
+            typecode (str): array typecode for each entry, e.g. 'H' for unsigned 16-bit.
+            count (int): Amount of entries to read.
+
+        Returns:
+            array: Array of read values. Entries past the end of data read as zero.
+        """
+        output = array(typecode)
+        length = output.itemsize * count
+        data = self.readView(length)
+        if len(data) == length:
+            output.frombytes(data)
+        else:
+            output.frombytes(bytes(data) + bytes(length - len(data)))
+        if _IS_HOST_BIG_ENDIAN:
+            output.byteswap()
+        return output
+
+    def readU16Array(self, count) -> array:
+        return self.readArray("H", count)
+
+    def readS16Array(self, count) -> array:
+        return self.readArray("h", count)
+
+    def readU32Array(self, count) -> array:
+        return self.readArray("I" if array("I").itemsize == 4 else "L", count)
+
     def readU32List(self, length):
-        out = []
-        for _index in range(length):
-            out.append(self.readU32())
-        return out
+        return self.readU32Array(length).tolist()
 
     def readU64(self):
-        return self.readUInt(8)
+        return self.readInt(8, signed=False)
     
     def readS16(self):
         return self.readInt(2)
@@ -79,10 +172,10 @@ class BinaryReader():
         return self.readInt(8)
     
     def readNullTerminatedString(self, encoding):
-        out = bytearray(b'')
-        while self.data[self.pos] != 0:
-            out.extend(self.read(1))
-        return out.decode(encoding)
+        end = self.pos
+        while self.data[end] != 0:
+            end += 1
+        return self.read(end - self.pos).decode(encoding)
     
     # TODO - Convert all padding characters to actual characters - be weary of encoding though
     def readPaddedString(self, length, encoding, padChar="\0"):
@@ -100,12 +193,11 @@ class BinaryWriter():
         return len(self.data)
 
     def pad(self, padLength, padChar = b'\x00'):
-        for _index in range(padLength):
-            self.data.extend(padChar)
+        if padLength > 0:
+            self.data.extend(padChar * padLength)
 
     def align(self, alignment, padChar = b'\x00'):
-        while self.tell() % alignment > 0:
-            self.data.extend(padChar)
+        self.pad((-self.tell() % alignment) // len(padChar), padChar = padChar)
 
     def dsAlign(self, alignment, extraPad, padChar = b'\x00'):
         tempAlignmentLength = self.tell()
@@ -113,6 +205,19 @@ class BinaryWriter():
         if self.tell() == tempAlignmentLength:
             self.pad(extraPad, padChar = padChar)
 
+    def reserve(self, length) -> int:
+        """Writes a zeroed placeholder to be patched later, e.g. with writeIntAt once an offset or length is known.
+
+        Args:
+            length (int): Length of placeholder in bytes.
+
+        Returns:
+            int: Offset of the placeholder.
+        """
+        offset = self.tell()
+        self.pad(length)
+        return offset
+
     def write(self, data):
         self.data.extend(data)
     
@@ -161,8 +266,29 @@ class BinaryWriter():
     def writeU32L(self, dataList):
         self.writeIntList(dataList, 4)
     
+    def writeIntAt(self, data, pos, length, signed = False):
+        """Overwrites an integer at a previously written position without moving the end of the data.
+
+        Args:
+            data (int): Value to write.
+            pos (int): Offset to write at.
+            length (int): Length of integer in bytes.
+            signed (bool, optional): True if value is signed. Defaults to False.
+        """
+        structInt = _STRUCT_INT.get((length, signed))
+        if structInt != None and 0 <= pos <= self.tell() - length:
+            structInt.pack_into(self.data, pos, data)
+        else:
+            self.insert(data.to_bytes(length, byteorder = 'little', signed = signed), pos)
+
+    def writeU16At(self, data, pos):
+        self.writeIntAt(data, pos, 2)
+
+    def writeU32At(self, data, pos):
+        self.writeIntAt(data, pos, 4)
+    
     def insert(self, data, pos):
-        insertionPos = pos
-        for singleByte in data:
-            self.data[insertionPos] = singleByte
-            insertionPos += 1
\ No newline at end of file
+        # Overwrites in place, so patches must land within the data rather than growing or shrinking it
+        if pos < 0 or pos + len(data) > len(self.data):
+            raise IndexError("Insertion at " + str(pos) + " of " + str(len(data)) + " bytes is outside writer of length " + str(len(self.data)))
+        self.data[pos:pos + len(data)] = data
\ No newline at end of file
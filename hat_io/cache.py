@@ -0,0 +1,182 @@
+from __future__ import annotations
+from collections import OrderedDict
+from hashlib import blake2b
+from os import fdopen, makedirs, remove, replace, scandir, utime
+from os.path import join
+from tempfile import mkstemp
+from typing import Optional
+
+class ByteCache():
+
+    EXTENSION_ENTRY = ".bin"
+
+    def __init__(self, pathCache : Optional[str] = None, maxMemoryBytes : int = 64 * 1024 * 1024, maxDiskBytes : int = 1024 * 1024 * 1024):
+        """Two-tier cache of bytes keyed by hex strings. Recently used entries are kept in memory and every entry is also stored on disk
+        if a directory is provided, so results can be shared across runs. Both tiers evict the least recently used entries once over
+        their size limit.
+
+        Args:
+            pathCache (Optional[str], optional): Directory for the on-disk tier. Defaults to None, which only caches in memory.
+            maxMemoryBytes (int, optional): Size limit of the in-memory tier. Defaults to 64MB.
+            maxDiskBytes (int, optional): Size limit of the on-disk tier. Defaults to 1GB.
+        """
+        self.pathCache      = pathCache
+        self.maxMemoryBytes = maxMemoryBytes
+        self.maxDiskBytes   = maxDiskBytes
+
+        self.countHits          : int = 0
+        self.countHitsDisk      : int = 0
+        self.countMisses        : int = 0
+
+        self._memory : OrderedDict[str, bytes] = OrderedDict()
+        self._lengthMemory : int = 0
+        self._disk : OrderedDict[str, int] = OrderedDict()
+        self._lengthDisk : int = 0
+
+        if self.pathCache != None:
+            makedirs(self.pathCache, exist_ok=True)
+            # Entries are touched when used, so modification time gives the least recently used order across runs
+            existing = []
+            with scandir(self.pathCache) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(ByteCache.EXTENSION_ENTRY):
+                        stat = entry.stat()
+                        existing.append((stat.st_mtime, entry.name[:-len(ByteCache.EXTENSION_ENTRY)], stat.st_size))
+            existing.sort()
+            for _time, key, length in existing:
+                self._disk[key] = length
+                self._lengthDisk += length
+            self._evictDisk()
+
+    def getHitRate(self) -> float:
+        """Gets the proportion of lookups that were served from the cache.
+
+        Returns:
+            float: Hit rate between 0 and 1.
+        """
+        if self.countHits + self.countMisses == 0:
+            return 0
+        return self.countHits / (self.countHits + self.countMisses)
+
+    def get(self, key : str) -> Optional[bytes]:
+        """Gets cached data.
+
+        Args:
+            key (str): Key for entry.
+
+        Returns:
+            Optional[bytes]: Data, or None if not cached.
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.countHits += 1
+            return self._memory[key]
+
+        if key in self._disk:
+            pathEntry = self._getPathEntry(key)
+            try:
+                with open(pathEntry, 'rb') as dataIn:
+                    data = dataIn.read()
+                if len(data) != self._disk[key]:
+                    # Damaged or cut short outside of this cache, so don't trust it
+                    raise IOError("Cache entry has unexpected length")
+                utime(pathEntry)
+                self._disk.move_to_end(key)
+            except IOError:
+                self._removeDisk(key)
+                data = None
+
+            if data != None:
+                self._putMemory(key, data)
+                self.countHits += 1
+                self.countHitsDisk += 1
+                return data
+
+        self.countMisses += 1
+        return None
+
+    def put(self, key : str, data : bytes):
+        """Caches data.
+
+        Args:
+            key (str): Key for entry. Must be safe to use as a filename.
+            data (bytes): Data.
+        """
+        data = bytes(data)
+        self._putMemory(key, data)
+
+        if self.pathCache != None and key not in self._disk and len(data) <= self.maxDiskBytes:
+            pathEntry = self._getPathEntry(key)
+            pathTemp = None
+            try:
+                # Write to a file unique to this writer then rename so other processes sharing the directory never see partial entries,
+                #     even when several write the same key at once
+                handleTemp, pathTemp = mkstemp(suffix=".tmp", dir=self.pathCache)
+                with fdopen(handleTemp, 'wb') as dataOut:
+                    dataOut.write(data)
+                replace(pathTemp, pathEntry)
+            except IOError:
+                if pathTemp != None:
+                    try:
+                        remove(pathTemp)
+                    except IOError:
+                        pass
+                return
+            self._disk[key] = len(data)
+            self._lengthDisk += len(data)
+            self._evictDisk()
+
+    def clear(self):
+        """Removes every entry from both tiers.
+        """
+        self._memory = OrderedDict()
+        self._lengthMemory = 0
+        for key in list(self._disk.keys()):
+            self._removeDisk(key)
+
+    def _getPathEntry(self, key : str) -> str:
+        return join(self.pathCache, key + ByteCache.EXTENSION_ENTRY)
+
+    def _putMemory(self, key : str, data : bytes):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        if len(data) > self.maxMemoryBytes:
+            return
+        self._memory[key] = data
+        self._lengthMemory += len(data)
+        while self._lengthMemory > self.maxMemoryBytes:
+            _key, evicted = self._memory.popitem(last=False)
+            self._lengthMemory -= len(evicted)
+
+    def _removeDisk(self, key : str):
+        length = self._disk.pop(key)
+        self._lengthDisk -= length
+        try:
+            remove(self._getPathEntry(key))
+        except IOError:
+            pass
+
+    def _evictDisk(self):
+        while self._lengthDisk > self.maxDiskBytes:
+            self._removeDisk(next(iter(self._disk)))
+
+class DecompressionCache(ByteCache):
+    """Cache of decompressed data, keyed by a hash of the compressed data and decompression method.
+    """
+
+    @staticmethod
+    def getKey(data : bytes, method : str) -> str:
+        """Gets the cache key for compressed data.
+
+        Args:
+            data (bytes): Compressed data.
+            method (str): Name of decompression method, including anything else that changes its output.
+
+        Returns:
+            str: Key for this data.
+        """
+        hasher = blake2b(method.encode("ascii"), digest_size=20)
+        hasher.update(b'\x00')
+        hasher.update(data)
+        return hasher.hexdigest()